@@ -0,0 +1,293 @@
+import os
+import time
+import math
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, Tuple
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from pymongo import ReturnDocument
+import logging
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+# "memory" keeps token buckets in this process, "mongodb" shares them across workers
+ADMISSION_SHARED_STATE = os.getenv("ADMISSION_SHARED_STATE", "memory")
+# Upload endpoints guarded by admission control
+ADMISSION_PATHS = ("/analytics/analyze/", "/analytics/missing-taps/")
+
+# Cost of a request is 1 unit plus 1 per ROWS_PER_COST_UNIT rows
+ROWS_PER_COST_UNIT = int(os.getenv("ADMISSION_ROWS_PER_COST_UNIT", "10000"))
+# Used to estimate rows from Content-Length before the upload is parsed
+ESTIMATED_BYTES_PER_ROW = int(os.getenv("ADMISSION_BYTES_PER_ROW", "120"))
+
+CLIENT_BURST = float(os.getenv("ADMISSION_CLIENT_BURST", "50"))
+CLIENT_REFILL_PER_SECOND = float(os.getenv("ADMISSION_CLIENT_REFILL_PER_SECOND", "0.5"))
+MAX_INFLIGHT_COST = float(os.getenv("ADMISSION_MAX_INFLIGHT_COST", "20"))
+MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "16"))
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "10"))
+# Proxies in front of the app that append the peer address to X-Forwarded-For
+# (1 for Vercel or Railway); 0 ignores the header, which clients can forge
+TRUSTED_PROXY_HOPS = int(os.getenv("ADMISSION_TRUSTED_PROXY_HOPS", "1"))
+MAX_TRACKED_CLIENTS = 10000
+
+
+def cost_for_rows(rows: int) -> float:
+    return 1 + rows / ROWS_PER_COST_UNIT
+
+
+def estimate_cost(content_length: Optional[int]) -> float:
+    return cost_for_rows((content_length or 0) // ESTIMATED_BYTES_PER_ROW)
+
+
+def client_id(request: Request) -> str:
+    # Entries left of the ones our proxies added come from the client and can be forged
+    forwarded = [entry.strip() for entry in request.headers.get("x-forwarded-for", "").split(",") if entry.strip()]
+    if TRUSTED_PROXY_HOPS and len(forwarded) >= TRUSTED_PROXY_HOPS:
+        return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+
+class InMemoryTokenBuckets:
+    """Per-client token buckets held in this process"""
+
+    def __init__(self, capacity: float = CLIENT_BURST, refill_per_second: float = CLIENT_REFILL_PER_SECOND):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        # client -> (tokens, last refill time), least recently updated first
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def _refilled(self, client: str) -> float:
+        tokens, updated_at = self._buckets.get(client, (self.capacity, time.monotonic()))
+        return min(self.capacity, tokens + (time.monotonic() - updated_at) * self.refill_per_second)
+
+    def _store(self, client: str, tokens: float):
+        self._buckets[client] = (tokens, time.monotonic())
+        self._buckets.move_to_end(client)
+        # Forget the longest idle clients, whose buckets are the closest to full
+        while len(self._buckets) > MAX_TRACKED_CLIENTS:
+            self._buckets.popitem(last=False)
+
+    async def take(self, client: str, cost: float) -> Tuple[bool, float]:
+        """Take cost tokens if available; returns (allowed, seconds until enough tokens)"""
+        tokens = self._refilled(client)
+        # Requests bigger than the bucket are allowed once the bucket is full
+        cost = min(cost, self.capacity)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._store(client, tokens)
+        return allowed, 0.0 if allowed else (cost - tokens) / self.refill_per_second
+
+    async def adjust(self, client: str, amount: float):
+        """Charge (positive) or refund (negative) tokens after the real cost is known"""
+        self._store(client, min(self.capacity, self._refilled(client) - amount))
+
+
+class MongoTokenBuckets:
+    """Per-client token buckets shared across workers through MongoDB"""
+
+    def __init__(self, collection, capacity: float = CLIENT_BURST, refill_per_second: float = CLIENT_REFILL_PER_SECOND):
+        self.collection = collection
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+
+    async def ensure_indexes(self):
+        # An idle bucket is full again after this long, so its document can go
+        refill_seconds = self.capacity / self.refill_per_second if self.refill_per_second > 0 else 86400
+        await self.collection.create_index("updated_at", expireAfterSeconds=max(1, math.ceil(refill_seconds)))
+
+    def _refill_stage(self, now: datetime) -> Dict[str, Any]:
+        elapsed_seconds = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        return {"$set": {
+            "tokens": {"$min": [
+                self.capacity,
+                {"$add": [{"$ifNull": ["$tokens", self.capacity]}, {"$multiply": [elapsed_seconds, self.refill_per_second]}]}
+            ]},
+            "updated_at": now
+        }}
+
+    async def take(self, client: str, cost: float) -> Tuple[bool, float]:
+        now = datetime.now(timezone.utc)
+        cost = min(cost, self.capacity)
+        # Refill and conditional take in one atomic pipeline update
+        bucket = await self.collection.find_one_and_update(
+            {"_id": client},
+            [
+                self._refill_stage(now),
+                {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]}}}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if bucket["allowed"]:
+            return True, 0.0
+        return False, (cost - bucket["tokens"]) / self.refill_per_second
+
+    async def adjust(self, client: str, amount: float):
+        now = datetime.now(timezone.utc)
+        await self.collection.update_one(
+            {"_id": client},
+            [
+                self._refill_stage(now),
+                {"$set": {"tokens": {"$min": [self.capacity, {"$subtract": ["$tokens", amount]}]}}}
+            ],
+            upsert=True
+        )
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Per-client rate limiting plus a global budget for the cost of in-flight uploads"""
+
+    def __init__(self, max_inflight_cost: float = MAX_INFLIGHT_COST, max_queue: int = MAX_QUEUE,
+                 queue_timeout: float = QUEUE_TIMEOUT_SECONDS):
+        self.max_inflight_cost = max_inflight_cost
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.buckets = None
+        self.in_flight_cost = 0.0
+        self.in_flight_requests = 0
+        self.queue_depth = 0
+        self._budget_changed = asyncio.Condition()
+        self.admitted = 0
+        self.rejected_rate_limited = 0
+        self.rejected_queue_full = 0
+        self.rejected_queue_timeout = 0
+
+    def _get_buckets(self, app):
+        if self.buckets is None:
+            if ADMISSION_SHARED_STATE == "mongodb":
+                self.buckets = MongoTokenBuckets(app.mongodb_client.compass_wrapped.rate_limits)
+            else:
+                self.buckets = InMemoryTokenBuckets()
+        return self.buckets
+
+    async def ensure_indexes(self, app):
+        buckets = self._get_buckets(app)
+        if isinstance(buckets, MongoTokenBuckets):
+            await buckets.ensure_indexes()
+
+    async def acquire(self, request: Request, cost: float) -> float:
+        """Admit a request or raise AdmissionRejected; returns the cost to release later"""
+        buckets = self._get_buckets(request.app)
+        client = client_id(request)
+        allowed, retry_after = await buckets.take(client, cost)
+        if not allowed:
+            self.rejected_rate_limited += 1
+            raise AdmissionRejected(429, "Too many uploads from this client, slow down", retry_after)
+
+        try:
+            return await self._reserve_budget(cost)
+        except AdmissionRejected:
+            # The server was busy, not the client: give its tokens back
+            await buckets.adjust(client, -cost)
+            raise
+
+    async def _reserve_budget(self, cost: float) -> float:
+        # A single upload bigger than the whole budget runs alone
+        cost = min(cost, self.max_inflight_cost)
+        async with self._budget_changed:
+            if self.in_flight_cost + cost > self.max_inflight_cost:
+                if self.queue_depth >= self.max_queue:
+                    self.rejected_queue_full += 1
+                    raise AdmissionRejected(503, "Server is busy, try again shortly", self.queue_timeout)
+                self.queue_depth += 1
+                try:
+                    await asyncio.wait_for(
+                        self._budget_changed.wait_for(lambda: self.in_flight_cost + cost <= self.max_inflight_cost),
+                        timeout=self.queue_timeout
+                    )
+                except asyncio.TimeoutError:
+                    self.rejected_queue_timeout += 1
+                    raise AdmissionRejected(503, "Server is busy, try again shortly", self.queue_timeout)
+                finally:
+                    self.queue_depth -= 1
+            self.in_flight_cost += cost
+            self.in_flight_requests += 1
+            self.admitted += 1
+        return cost
+
+    async def release(self, cost: float):
+        async with self._budget_changed:
+            self.in_flight_cost -= cost
+            self.in_flight_requests -= 1
+            self._budget_changed.notify_all()
+
+    async def settle(self, request: Request, rows: int):
+        """Charge the client the difference between the estimated and the real cost"""
+        estimated = getattr(request.state, "admission_estimated_cost", None)
+        if estimated is None:
+            return
+        await self._get_buckets(request.app).adjust(client_id(request), cost_for_rows(rows) - estimated)
+        request.state.admission_estimated_cost = None
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "shared_state": ADMISSION_SHARED_STATE,
+            "queue_depth": self.queue_depth,
+            "in_flight_requests": self.in_flight_requests,
+            "in_flight_cost": round(self.in_flight_cost, 2),
+            "max_inflight_cost": self.max_inflight_cost,
+            "admitted": self.admitted,
+            "rejected": {
+                "rate_limited": self.rejected_rate_limited,
+                "queue_full": self.rejected_queue_full,
+                "queue_timeout": self.rejected_queue_timeout
+            }
+        }
+
+
+admission_controller = AdmissionController()
+
+
+async def admission_middleware(request: Request, call_next):
+    """Reject or queue expensive uploads before their body is parsed"""
+    if not ADMISSION_ENABLED or request.method != "POST" or request.url.path not in ADMISSION_PATHS:
+        return await call_next(request)
+
+    try:
+        content_length = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        content_length = 0
+    estimated_cost = estimate_cost(content_length)
+
+    try:
+        cost = await admission_controller.acquire(request, estimated_cost)
+    except AdmissionRejected as e:
+        return JSONResponse(
+            status_code=e.status_code,
+            content={"detail": e.detail},
+            headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))}
+        )
+
+    request.state.admission_estimated_cost = estimated_cost
+    try:
+        response = await call_next(request)
+    except BaseException:
+        await admission_controller.release(cost)
+        raise
+
+    # Streamed responses keep computing while the body is sent, so release afterwards
+    body_iterator = response.body_iterator
+
+    async def release_after_body():
+        try:
+            async for chunk in body_iterator:
+                yield chunk
+        finally:
+            await admission_controller.release(cost)
+
+    response.body_iterator = release_after_body()
+    return response
@@ -2,7 +2,13 @@ from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
-from .routers import stats
+import asyncio
+import importlib
+from .routers import stats, analytics
+from .services.stats_write_buffer import stats_write_buffer
+from .services.process_pool import get_process_pool, shutdown_process_pool
+from .services.user_stats_service import UserStatsService
+from .admission import admission_middleware, admission_controller
 from dotenv import load_dotenv
 import logging
 import traceback
@@ -20,6 +26,9 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Admission control for uploads; registered first so CORS headers wrap its 429/503s
+app.middleware("http")(admission_middleware)
+
 # CORS configuration - more permissive for development
 app.add_middleware(
     CORSMiddleware,
@@ -33,14 +42,49 @@ app.add_middleware(
 # MongoDB connection
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 
+# Heavy analytics dependencies (pandas/numpy) are imported lazily on the
+# analytics path. Set PREWARM_ANALYTICS=true to load them in the background
+# at startup instead, so the first upload doesn't pay for the import.
+PREWARM_ANALYTICS = os.getenv("PREWARM_ANALYTICS", "false").lower() == "true"
+PREWARM_MODULES = (
+    "app.services.analytics_service",
+)
+
+def prewarm_heavy_imports():
+    for module_name in PREWARM_MODULES:
+        try:
+            importlib.import_module(module_name)
+        except Exception as e:
+            logger.error(f"Failed to pre-warm {module_name}: {e}")
+    logger.info("Pre-warmed analytics dependencies")
+
+async def ensure_indexes():
+    try:
+        await UserStatsService(app.mongodb_client).ensure_indexes()
+        await admission_controller.ensure_indexes(app)
+    except Exception as e:
+        logger.error(f"Failed to create MongoDB indexes: {e}")
+
 @app.on_event("startup")
 async def startup_db_client():
     app.mongodb_client = AsyncIOMotorClient(MONGODB_URL)
     app.mongodb = app.mongodb_client.compass_wrapped
+    stats_write_buffer.start()
+    # One pool for the app's lifetime; its workers start on the first sharded analysis
+    get_process_pool()
+    # Don't hold up startup (or fail it) if MongoDB is slow to answer
+    asyncio.get_running_loop().create_task(ensure_indexes())
+    if PREWARM_ANALYTICS:
+        # Import off the event loop so the health check answers immediately
+        asyncio.get_running_loop().run_in_executor(None, prewarm_heavy_imports)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Buffered stats must reach MongoDB before the client goes away
+    await stats_write_buffer.close()
     app.mongodb_client.close()
+    # Off the event loop, since it waits for running analyses to finish
+    await asyncio.get_running_loop().run_in_executor(None, shutdown_process_pool)
 
 # Global exception handler
 @app.exception_handler(Exception)
@@ -58,6 +102,7 @@ async def global_exception_handler(request: Request, exc: Exception):
 
 # Include routers
 app.include_router(stats.router)
+app.include_router(analytics.router)
 
 @app.get("/")
 async def root():
@@ -25,6 +25,12 @@ class TimeStats(BaseModel):
     total_hours: float
     total_days: float
     average_trip_duration: float
+    median_trip_duration: Optional[float] = None
+    p90_trip_duration: Optional[float] = None
+    longest_trip: Optional[Dict[str, Any]] = None
+    duration_histogram: Optional[List[Dict[str, Any]]] = None
+    by_mode: Optional[Dict[str, Dict[str, Any]]] = None
+    outlier_filter: Optional[Dict[str, Any]] = None
 
 class TransferStats(BaseModel):
     """Model for transfer statistics"""
@@ -48,6 +54,15 @@ class MissingTaps(BaseModel):
     missing_tap_ins: int
     missing_tap_outs: int
     details: Optional[List[Dict[str, Any]]]
+    upload_id: Optional[str] = None
+    next_cursor: Optional[str] = None
+
+class MissingTapsPage(BaseModel):
+    """Model for one page of missing tap events from an upload"""
+    upload_id: str
+    total: int
+    details: List[Dict[str, Any]]
+    next_cursor: Optional[str] = None
 
 class CompassWrappedStats(BaseModel):
     """Complete model for Compass Wrapped statistics"""
@@ -0,0 +1,117 @@
+import os
+import re
+import sys
+import hmac
+import uuid
+import cProfile
+import tempfile
+import threading
+from collections import Counter
+from typing import Optional
+from fastapi import Request, HTTPException
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Profiling is only available when an admin token is configured
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "compass-wrapped-profiles"))
+PROFILE_MAX_STORED = int(os.getenv("PROFILE_MAX_STORED", "20"))
+PROFILE_SAMPLE_INTERVAL_SECONDS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5")) / 1000
+
+PROFILE_HEADER = "x-profile"
+ADMIN_TOKEN_HEADER = "x-admin-token"
+PROFILE_KINDS = {"pstats": ".pstats", "collapsed": ".collapsed"}
+PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def is_admin(request: Request) -> bool:
+    token = request.headers.get(ADMIN_TOKEN_HEADER)
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+def require_admin(request: Request):
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+def profiling_requested(request: Request) -> bool:
+    """Whether the request asked to be profiled; raises 403 unless it comes from an admin"""
+    if request.headers.get(PROFILE_HEADER, "").lower() not in ("1", "true"):
+        return False
+    require_admin(request)
+    return True
+
+
+class RequestProfiler:
+    """cProfile plus a stack sampler for the calling thread, for use around one request's work
+
+    cProfile gives exact per-function timings (pstats); the sampler records whole
+    stacks so the result can be rendered as a flame graph (collapsed stacks).
+    It can be entered several times, e.g. around separate steps of one request,
+    and accumulates across them.
+    """
+
+    def __init__(self, sample_interval: float = PROFILE_SAMPLE_INTERVAL_SECONDS):
+        self.sample_interval = sample_interval
+        self.profile_id = uuid.uuid4().hex
+        self.profile = cProfile.Profile()
+        self.stacks: Counter = Counter()
+        self._thread_id = None
+        self._stop = None
+        self._sampler = None
+
+    def __enter__(self):
+        self._thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+        self._sampler.start()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+        self._stop.set()
+        self._sampler.join()
+        return False
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def save(self, directory: str = PROFILE_DIR) -> str:
+        """Write <id>.pstats and <id>.collapsed to directory and return the profile id"""
+        os.makedirs(directory, exist_ok=True)
+        self.profile.dump_stats(profile_path(self.profile_id, "pstats", directory))
+        with open(profile_path(self.profile_id, "collapsed", directory), "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        _prune_profiles(directory)
+        logger.info(f"Saved request profile {self.profile_id} ({sum(self.stacks.values())} samples)")
+        return self.profile_id
+
+
+def profile_path(profile_id: str, kind: str, directory: str = PROFILE_DIR) -> Optional[str]:
+    """Path of a stored profile file, or None for an unknown kind or malformed id"""
+    if kind not in PROFILE_KINDS or not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    return os.path.join(directory, profile_id + PROFILE_KINDS[kind])
+
+
+def _prune_profiles(directory: str):
+    """Keep only the PROFILE_MAX_STORED most recent profiles"""
+    paths = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".pstats")]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[PROFILE_MAX_STORED:]:
+        for suffix in PROFILE_KINDS.values():
+            try:
+                os.remove(path[:-len(".pstats")] + suffix)
+            except FileNotFoundError:
+                pass
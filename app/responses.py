@@ -0,0 +1,125 @@
+import os
+import gzip
+import json
+import hashlib
+from typing import Any, Optional
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+
+# msgpack and brotli are optional; without them responses fall back to JSON / gzip
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+SSE_MEDIA_TYPE = "text/event-stream"
+# Every representation of a resource shares its ETag, so caches must key on these
+VARY_HEADER = "Accept, Accept-Encoding"
+
+
+def compute_etag(*parts: Any) -> str:
+    """Weak ETag from the given parts, shared by every encoding of the same content"""
+    digest = hashlib.sha256("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'W/"{digest[:32]}"'
+
+
+def _accepts(header: str, token: str) -> bool:
+    """Whether a comma separated Accept-style header lists token with a non-zero q value"""
+    for item in header.split(","):
+        name, *params = [part.strip() for part in item.split(";")]
+        if name.lower() != token:
+            continue
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def etag_matches(request: Request, etag: Optional[str]) -> bool:
+    if not etag:
+        return False
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Weak comparison: ignore the W/ prefix on either side
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in candidates
+
+
+def encode_body(content: Any, media_type: str) -> bytes:
+    data = jsonable_encoder(content)
+    if media_type in MSGPACK_MEDIA_TYPES:
+        return msgpack.packb(data, use_bin_type=True)
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def negotiated_response(request: Request, content: Any, etag: str = None, status_code: int = 200) -> Response:
+    """
+    Encode content as JSON or MessagePack depending on the Accept header, compress
+    it with brotli or gzip above COMPRESSION_MIN_BYTES, and answer 304 when the
+    client's If-None-Match matches etag
+    """
+    headers = {"Vary": VARY_HEADER}
+    if etag:
+        headers["ETag"] = etag
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    accept = request.headers.get("accept", "")
+    media_type = "application/json"
+    if msgpack is not None:
+        media_type = next((t for t in MSGPACK_MEDIA_TYPES if _accepts(accept, t)), media_type)
+    body = encode_body(content, media_type)
+
+    if len(body) >= COMPRESSION_MIN_BYTES:
+        accept_encoding = request.headers.get("accept-encoding", "")
+        if brotli is not None and _accepts(accept_encoding, "br"):
+            body = compress_body(body, "br")
+            headers["Content-Encoding"] = "br"
+        elif _accepts(accept_encoding, "gzip"):
+            body = compress_body(body, "gzip")
+            headers["Content-Encoding"] = "gzip"
+
+    return Response(content=body, status_code=status_code, media_type=media_type, headers=headers)
+
+
+def streaming_media_type(request: Request) -> Optional[str]:
+    """NDJSON or SSE if the client asked for a progressive response, otherwise None"""
+    accept = request.headers.get("accept", "")
+    for media_type in (SSE_MEDIA_TYPE, NDJSON_MEDIA_TYPE):
+        if _accepts(accept, media_type):
+            return media_type
+    return None
+
+
+def format_stream_event(media_type: str, event: str, data: Any) -> bytes:
+    """One server-sent event, or one NDJSON line with the event name folded in"""
+    if media_type == SSE_MEDIA_TYPE:
+        return b"event: " + event.encode("utf-8") + b"\ndata: " + encode_body(data, "application/json") + b"\n\n"
+    return encode_body({"event": event, **data}, "application/json") + b"\n"
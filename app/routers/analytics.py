@@ -1,11 +1,21 @@
-from fastapi import APIRouter, UploadFile, File, Query
-from fastapi.responses import JSONResponse
-import pandas as pd
-from typing import Dict, Any
+from fastapi import APIRouter, UploadFile, File, Query, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, Any, List, Tuple, Callable
+from functools import partial
+from contextlib import nullcontext
+import os
 import traceback
 import logging
 
-from app.services.analytics_service import AnalyticsService
+from app.models import MissingTapsPage
+from app.services.upload_cache import upload_cache, compute_upload_id
+from app.admission import admission_controller
+from app.profiling import RequestProfiler, profiling_requested, require_admin, profile_path
+from app.responses import (
+    negotiated_response, compute_etag, etag_matches,
+    streaming_media_type, format_stream_event, VARY_HEADER
+)
 
 router = APIRouter(
     prefix="/analytics",
@@ -13,16 +23,84 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+def _profiled(profiler, func: Callable, *args, **kwargs):
+    """Run func under the request profiler, if any; called in the worker thread so cProfile sees it"""
+    with profiler or nullcontext():
+        return func(*args, **kwargs)
+
+def _analysis_components(service, min_trip_minutes: float = None, max_trip_minutes: float = None,
+                         upload_id: str = None) -> List[Tuple[str, Callable]]:
+    """Analysis components, cheapest first so streamed results arrive as early as possible"""
+    return [
+        ("total_stats", service.calculate_total_stats),
+        ("route_stats", service.calculate_route_stats),
+        ("missing_taps", lambda df: service.find_missing_taps(
+            df, upload_id, upload_cache.get(upload_id, "missing_tap_events")
+        )),
+        ("personality", service.determine_personality),
+        ("time_stats", partial(service.calculate_time_stats, min_trip_minutes=min_trip_minutes,
+                               max_trip_minutes=max_trip_minutes)),
+        ("achievements", service.calculate_achievements),
+        ("transfer_stats", service.calculate_transfer_stats)
+    ]
+
+async def _stream_analysis(service, df, file_info: Dict[str, Any], estimated_trips_per_week: int, media_type: str,
+                           min_trip_minutes: float = None, max_trip_minutes: float = None, upload_id: str = None):
+    """Emit each component as soon as it is computed, with failures as error events"""
+    errors = {}
+    yield format_stream_event(media_type, "file_info", {"data": file_info})
+
+    try:
+        time_period = await run_in_threadpool(service.determine_time_period, df)
+        yield format_stream_event(media_type, "component", {"name": "time_period", "data": time_period.dict()})
+        if estimated_trips_per_week is not None:
+            user_estimate = await run_in_threadpool(
+                service.calculate_user_estimate, df, estimated_trips_per_week, time_period
+            )
+            yield format_stream_event(media_type, "component", {"name": "user_estimate", "data": user_estimate.dict()})
+    except Exception as e:
+        errors["time_period"] = str(e)
+        logging.error(f"Error in time_period: {str(e)}")
+        yield format_stream_event(media_type, "error", {"name": "time_period", "message": str(e)})
+
+    for component_name, analysis_function in _analysis_components(service, min_trip_minutes, max_trip_minutes,
+                                                                  upload_id):
+        try:
+            # Off the event loop, so each chunk is flushed while the next component runs
+            data = await run_in_threadpool(analysis_function, df)
+            yield format_stream_event(media_type, "component", {"name": component_name, "data": data})
+        except Exception as e:
+            errors[component_name] = str(e)
+            logging.error(f"Error in {component_name}: {str(e)}")
+            logging.debug(traceback.format_exc())
+            yield format_stream_event(media_type, "error", {"name": component_name, "message": str(e)})
+
+    yield format_stream_event(media_type, "complete", {"status": {"success": not errors, "errors": errors}})
+
 @router.post("/analyze/")
 async def analyze_compass_data(
+    request: Request,
     file: UploadFile = File(...),
-    estimated_trips_per_week: int = Query(None, description="User's estimated number of trips per week")
+    estimated_trips_per_week: int = Query(None, description="User's estimated number of trips per week"),
+    partition_by: str = Query(None, description="Column identifying each card/user in a merged export"),
+    min_trip_minutes: float = Query(None, ge=0, description="Trips this short or shorter are ignored in time stats (default 0)"),
+    max_trip_minutes: float = Query(None, gt=0, description="Trips this long or longer are ignored in time stats (default 240)")
 ) -> dict:
     """
-    Upload a Compass Card CSV file to get comprehensive statistics
+    Upload a Compass Card CSV file to get comprehensive statistics.
+    With partition_by, returns one result per card/user ranked against the others.
+    Supports MessagePack via Accept, gzip/brotli via Accept-Encoding, and
+    If-None-Match with the ETag of a previous analysis of the same file.
+    With Accept: application/x-ndjson or text/event-stream, each component is
+    streamed as soon as it is computed (not supported with partition_by).
+    min_trip_minutes / max_trip_minutes override the outlier filter for trip durations.
+    Admins can send X-Profile: true to profile the request; the profile id is
+    returned in X-Profile-Id.
     """
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="Only CSV files are allowed")
+    if min_trip_minutes is not None and max_trip_minutes is not None and min_trip_minutes >= max_trip_minutes:
+        raise HTTPException(status_code=400, detail="min_trip_minutes must be less than max_trip_minutes")
     
     # Initialize result object with metadata
     result = {
@@ -36,10 +114,26 @@ async def analyze_compass_data(
         }
     }
     
+    profiler = RequestProfiler() if profiling_requested(request) else None
+    
+    # Imported here so pandas is only loaded once an upload actually arrives
+    from app.services.analytics_service import AnalyticsService
+
     try:
         # Read file once
         contents = await file.read()
-        df = AnalyticsService().process_csv(contents)
+        # The result only depends on the file contents, its name (echoed in file_info) and the query parameters
+        upload_id = compute_upload_id(contents)
+        etag = compute_etag(upload_id, file.filename, estimated_trips_per_week, partition_by,
+                            min_trip_minutes, max_trip_minutes)
+        if profiler is None and etag_matches(request, etag):
+            return negotiated_response(request, None, etag)
+
+        # Parsing and analysis run off the event loop; only they are profiled
+        df = await run_in_threadpool(_profiled, profiler, AnalyticsService().process_csv, contents)
+        await admission_controller.settle(request, len(df))
+        if partition_by and partition_by not in df.columns:
+            raise HTTPException(status_code=400, detail=f"Unknown partition column: {partition_by}")
         
         # Update file info
         result["file_info"].update({
@@ -49,32 +143,40 @@ async def analyze_compass_data(
             "journeys": df['JourneyId'].nunique()
         })
         
-        # Process each analysis component independently
-        analysis_components = [
-            ("total_stats", AnalyticsService().calculate_total_stats),
-            ("route_stats", AnalyticsService().calculate_route_stats),
-            ("time_stats", AnalyticsService().calculate_time_stats),
-            ("transfer_stats", AnalyticsService().calculate_transfer_stats),
-            ("personality", AnalyticsService().determine_personality),
-            ("achievements", AnalyticsService().calculate_achievements),
-            ("missing_taps", AnalyticsService().find_missing_taps)
-        ]
+        stream_media_type = streaming_media_type(request)
+        if stream_media_type and not partition_by and profiler is None:
+            headers = {"ETag": etag, "Vary": VARY_HEADER, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            return StreamingResponse(
+                _stream_analysis(AnalyticsService(), df, result["file_info"], estimated_trips_per_week, stream_media_type,
+                                 min_trip_minutes, max_trip_minutes, upload_id),
+                media_type=stream_media_type,
+                headers=headers
+            )
         
-        # Process each component and handle exceptions
-        for component_name, analysis_function in analysis_components:
-            try:
-                result[component_name] = analysis_function(df)
-            except Exception as e:
-                result["status"]["success"] = False
-                result["status"]["errors"][component_name] = str(e)
-                result[component_name] = None
-                # Log the error for debugging
-                logging.error(f"Error in {component_name}: {str(e)}")
-                logging.debug(traceback.format_exc())
-        
-        # Generate statistics
-        return AnalyticsService().generate_compass_wrapped(df, estimated_trips_per_week)
+        # Generate statistics; each component's failure is recorded instead of failing the request
+        errors = result["status"]["errors"]
+        service = AnalyticsService()
+        if partition_by:
+            build = partial(service.generate_partitioned_wrapped, df, partition_by, estimated_trips_per_week,
+                            min_trip_minutes, max_trip_minutes, errors=errors)
+        else:
+            # Missing tap events are reused if already cached, and cached for paging otherwise
+            build = partial(service.generate_compass_wrapped, df, estimated_trips_per_week,
+                            min_trip_minutes=min_trip_minutes, max_trip_minutes=max_trip_minutes,
+                            upload_id=upload_id, missing_tap_events=upload_cache.get(upload_id, "missing_tap_events"),
+                            errors=errors)
+        wrapped = await run_in_threadpool(_profiled, profiler, build)
+        result["status"]["success"] = not errors
+        result.update(wrapped)
+        if profiler is None:
+            return negotiated_response(request, result, etag)
+        response = negotiated_response(request, result)
+        response.headers["X-Profile-Id"] = profiler.save()
+        response.headers["Cache-Control"] = "no-store"
+        return response
     
+    except HTTPException:
+        raise
     except Exception as e:
         # Handle critical errors in file processing
         result["status"]["success"] = False
@@ -82,4 +184,90 @@ async def analyze_compass_data(
         return JSONResponse(
             status_code=500,
             content=result
-        ) 
\ No newline at end of file
+        ) 
+
+def _missing_taps_page(upload_id: str, events: list, cursor: str, limit: int) -> MissingTapsPage:
+    try:
+        offset = int(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    end = offset + limit
+    return MissingTapsPage(
+        upload_id=upload_id,
+        total=len(events),
+        details=events[offset:end],
+        next_cursor=str(end) if end < len(events) else None
+    )
+
+@router.post("/missing-taps/", response_model=MissingTapsPage)
+async def list_missing_taps(
+    request: Request,
+    file: UploadFile = File(...),
+    limit: int = Query(50, ge=1, le=1000, description="Maximum events per page")
+) -> MissingTapsPage:
+    """
+    Upload a Compass Card CSV file and get the first page of all missing tap events.
+    Use next_cursor with GET /analytics/missing-taps/{upload_id} for the following pages.
+    """
+    if not file.filename.endswith('.csv'):
+        raise HTTPException(status_code=400, detail="Only CSV files are allowed")
+
+    contents = await file.read()
+    upload_id = compute_upload_id(contents)
+    events = upload_cache.get(upload_id, "missing_tap_events")
+    if events is None:
+        from app.services.analytics_service import AnalyticsService
+
+        service = AnalyticsService()
+        df = await run_in_threadpool(service.process_csv, contents)
+        await admission_controller.settle(request, len(df))
+        events = await run_in_threadpool(service.list_missing_tap_events, df)
+        upload_cache.set(upload_id, "missing_tap_events", events)
+
+    return negotiated_response(
+        request,
+        _missing_taps_page(upload_id, events, None, limit),
+        compute_etag(upload_id, "missing-taps", None, limit)
+    )
+
+@router.get("/missing-taps/{upload_id}", response_model=MissingTapsPage)
+async def get_missing_taps_page(
+    request: Request,
+    upload_id: str,
+    cursor: str = Query(None, description="Cursor returned by the previous page"),
+    limit: int = Query(50, ge=1, le=1000, description="Maximum events per page")
+) -> MissingTapsPage:
+    """
+    Get a page of missing tap events for a previously uploaded file
+    """
+    events = upload_cache.get(upload_id, "missing_tap_events")
+    if events is None:
+        raise HTTPException(status_code=404, detail="Upload not found or expired, please upload the file again")
+
+    return negotiated_response(
+        request,
+        _missing_taps_page(upload_id, events, cursor, limit),
+        compute_etag(upload_id, "missing-taps", cursor, limit)
+    )
+
+@router.get("/admission/metrics")
+async def get_admission_metrics() -> dict:
+    """
+    Queue depth, in-flight cost and rejection counts for upload admission control
+    """
+    return admission_controller.metrics()
+
+@router.get("/profiles/{profile_id}/{kind}")
+async def get_profile(request: Request, profile_id: str, kind: str):
+    """
+    Download a stored request profile as pstats or collapsed stacks (admin only)
+    """
+    require_admin(request)
+    path = profile_path(profile_id, kind)
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    media_type = "text/plain" if kind == "collapsed" else "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=os.path.basename(path))
@@ -1,9 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request, Query
 from typing import Optional
 from ..models import UserStats, UserStatsResponse
 from ..services.user_stats_service import UserStatsService
+from ..services.stats_cache import stats_cache
 from motor.motor_asyncio import AsyncIOMotorClient
 from ..dependencies import get_db
+from ..responses import negotiated_response, compute_etag
 
 router = APIRouter(
     prefix="/stats",
@@ -13,26 +15,37 @@ router = APIRouter(
 
 @router.post("/user", response_model=UserStatsResponse)
 async def save_user_stats(
+    request: Request,
     stats: UserStats,
+    durable: Optional[bool] = Query(None, description="Wait for the write to reach MongoDB before responding"),
     db: AsyncIOMotorClient = Depends(get_db)
 ) -> UserStatsResponse:
     """
     Save user statistics and get their transit personality and rankings
     """
     stats_service = UserStatsService(db)
-    return await stats_service.process_user_stats(stats)
+    response = await stats_service.process_user_stats(stats, durable)
+    return negotiated_response(request, response)
 
 @router.get("/user/{user_id}", response_model=Optional[UserStatsResponse])
 async def get_user_stats(
+    request: Request,
     user_id: str,
     db: AsyncIOMotorClient = Depends(get_db)
 ) -> Optional[UserStatsResponse]:
     """
-    Get user statistics by user ID
+    Get user statistics by user ID (read-only, served from cache when fresh)
     """
     stats_service = UserStatsService(db)
-    stats = await stats_service.get_user_stats(user_id)
-    if not stats:
+    response = await stats_service.get_cached_user_stats_response(user_id)
+    if not response:
         raise HTTPException(status_code=404, detail="User stats not found")
     
-    return await stats_service.process_user_stats(stats) 
\ No newline at end of file
+    return negotiated_response(request, response, compute_etag(response.model_dump_json()))
+
+@router.get("/cache/metrics")
+async def get_stats_cache_metrics() -> dict:
+    """
+    Hit rate and size of the user stats response cache
+    """
+    return stats_cache.metrics() 
\ No newline at end of file
@@ -0,0 +1,282 @@
+from typing import Dict, List, Any, Callable, Iterable, Optional, Set, Tuple
+import numpy as np
+import pandas as pd
+
+from .aggregates import (
+    positioned_counts, grouped_positioned_counts, merge_positioned_counts, to_value_counts,
+    min_timestamp, max_timestamp
+)
+
+Features = Dict[str, Any]
+
+
+class Feature:
+    """A value achievement rules can use
+
+    Base features are computed from the parsed frame and merged across shards;
+    derived features are computed from other features after merging. A base
+    feature's compute_grouped(df, column) computes it for every card of a merged
+    export in one pass, returning {card: value}.
+    """
+
+    def __init__(self, name: str, compute: Callable[[pd.DataFrame], Any] = None,
+                 merge: Callable[[Any, Any], Any] = None, derive: Callable[[Features], Any] = None,
+                 requires: Tuple[str, ...] = (), compute_grouped: Callable[[pd.DataFrame, str], Dict[Any, Any]] = None):
+        self.name = name
+        self.compute = compute
+        self.compute_grouped = compute_grouped
+        self.merge = merge
+        self.derive = derive
+        self.requires = requires
+
+    @property
+    def is_base(self) -> bool:
+        return self.compute is not None
+
+
+class AchievementRule:
+    """An achievement awarded when condition holds; name and description are formatted with the features
+
+    Only the first matching rule of a group is awarded, so tiers are listed highest first.
+    """
+
+    def __init__(self, name: str, description: str, requires: Tuple[str, ...],
+                 condition: Callable[[Features], bool], group: str = None):
+        self.name = name
+        self.description = description
+        self.requires = requires
+        self.condition = condition
+        self.group = group
+
+
+def _route_numbers(df: pd.DataFrame) -> pd.Series:
+    """First number in each Transaction, extracted once per distinct transaction text"""
+    codes, transactions = pd.factorize(df['Transaction'])
+    numbers = pd.Series(transactions, dtype=object).str.extract(r'(\d+)')[0].to_numpy()
+    # factorize marks missing transactions with -1; point them at a trailing NaN
+    numbers = np.append(numbers, np.nan)
+    return pd.Series(numbers[codes], index=df.index, dtype=object)
+
+
+def _multi_transfer_journeys(df: pd.DataFrame) -> int:
+    """Count journeys with 3 or more transfers"""
+    transfers_per_journey = (df['TransactionType'] == 'Transfer').groupby(df['JourneyId']).sum()
+    return int((transfers_per_journey >= 3).sum())
+
+
+def _grouped_multi_transfer_journeys(df: pd.DataFrame, column: str) -> Dict[Any, int]:
+    transfers_per_journey = (df['TransactionType'] == 'Transfer').groupby([df[column], df['JourneyId']]).sum()
+    counts = (transfers_per_journey >= 3).groupby(level=0).sum()
+    return {key: int(count) for key, count in counts.items()}
+
+
+def _travel_dates(df: pd.DataFrame) -> np.ndarray:
+    return np.unique(df['DateTime'].dropna().to_numpy().astype('datetime64[D]'))
+
+
+def _grouped_travel_dates(df: pd.DataFrame, column: str) -> Dict[Any, np.ndarray]:
+    dates = pd.DataFrame({'key': df[column], 'date': df['DateTime'].dt.normalize()}).dropna().drop_duplicates()
+    return {
+        key: np.sort(group.to_numpy().astype('datetime64[D]'))
+        for key, group in dates.groupby('key', sort=False)['date']
+    }
+
+
+def _grouped_series(values: pd.Series) -> Dict[Any, Any]:
+    return dict(values.items())
+
+
+def _top_route(features: Features) -> Tuple[Optional[str], int]:
+    route_counts = to_value_counts(features["route_counts"])
+    if route_counts.empty:
+        return None, 0
+    return route_counts.index[0], int(route_counts.iloc[0])
+
+
+def _longest_streak(features: Features) -> int:
+    """Most consecutive days with at least one tap"""
+    dates = features["travel_dates"]
+    if len(dates) == 0:
+        return 0
+    breaks = np.flatnonzero(np.diff(dates).astype(int) != 1)
+    run_ends = np.concatenate(([-1], breaks, [len(dates) - 1]))
+    return int(np.diff(run_ends).max())
+
+
+def _timestamp_or_none(value) -> Optional[pd.Timestamp]:
+    return None if pd.isna(value) else value
+
+
+FEATURES: Dict[str, Feature] = {}
+
+
+def register_feature(feature: Feature) -> Feature:
+    FEATURES[feature.name] = feature
+    return feature
+
+
+register_feature(Feature(
+    "total_trips",
+    compute=lambda df: int(df['JourneyId'].nunique()),
+    compute_grouped=lambda df, column: {
+        key: int(count) for key, count in df.groupby(column)['JourneyId'].nunique().items()
+    },
+    merge=lambda a, b: a + b
+))
+# Positioned counts, so merged shards break ties like value_counts() on the whole upload
+register_feature(Feature(
+    "route_counts",
+    compute=lambda df: positioned_counts(_route_numbers(df)),
+    compute_grouped=lambda df, column: grouped_positioned_counts(df[column], _route_numbers(df)),
+    merge=merge_positioned_counts
+))
+register_feature(Feature("multi_transfer_journeys", compute=_multi_transfer_journeys,
+                         compute_grouped=_grouped_multi_transfer_journeys, merge=lambda a, b: a + b))
+register_feature(Feature(
+    "first_trip",
+    compute=lambda df: df['DateTime'].min(),
+    compute_grouped=lambda df, column: _grouped_series(df.groupby(column)['DateTime'].min()),
+    merge=min_timestamp
+))
+register_feature(Feature(
+    "last_trip",
+    compute=lambda df: df['DateTime'].max(),
+    compute_grouped=lambda df, column: _grouped_series(df.groupby(column)['DateTime'].max()),
+    merge=max_timestamp
+))
+register_feature(Feature("travel_dates", compute=_travel_dates, compute_grouped=_grouped_travel_dates,
+                         merge=np.union1d))
+register_feature(Feature("top_route", derive=lambda f: _top_route(f)[0], requires=("route_counts",)))
+register_feature(Feature("top_route_count", derive=lambda f: _top_route(f)[1], requires=("route_counts",)))
+register_feature(Feature("earliest_trip", derive=lambda f: _timestamp_or_none(f["first_trip"]),
+                         requires=("first_trip",)))
+register_feature(Feature("latest_trip", derive=lambda f: _timestamp_or_none(f["last_trip"]),
+                         requires=("last_trip",)))
+register_feature(Feature(
+    "days_active",
+    derive=lambda f: (f["latest_trip"] - f["earliest_trip"]).days + 1
+    if f["earliest_trip"] is not None and f["latest_trip"] is not None else 0,
+    requires=("earliest_trip", "latest_trip")
+))
+register_feature(Feature("longest_streak", derive=_longest_streak, requires=("travel_dates",)))
+
+# Features reported in fun_stats whatever rules are registered
+FUN_STAT_FEATURES = ("total_trips", "earliest_trip", "latest_trip", "days_active", "longest_streak")
+
+ACHIEVEMENT_RULES: List[AchievementRule] = []
+
+
+def register_rule(rule: AchievementRule) -> AchievementRule:
+    ACHIEVEMENT_RULES.append(rule)
+    return rule
+
+
+# Trip milestones
+register_rule(AchievementRule("Transit Veteran", "You took {total_trips} trips this year!",
+                              ("total_trips",), lambda f: f["total_trips"] >= 300, group="trip_milestone"))
+register_rule(AchievementRule("Regular Commuter", "You took {total_trips} trips this year!",
+                              ("total_trips",), lambda f: f["total_trips"] >= 100, group="trip_milestone"))
+register_rule(AchievementRule("Transit Enthusiast", "You took {total_trips} trips this year!",
+                              ("total_trips",), lambda f: f["total_trips"] >= 50, group="trip_milestone"))
+# Most used route
+register_rule(AchievementRule("R{top_route} Warrior", "You used the R{top_route} route {top_route_count} times!",
+                              ("top_route", "top_route_count"), lambda f: f["top_route"] is not None))
+register_rule(AchievementRule("Multi-Transfer Master",
+                              "You made {multi_transfer_journeys} journeys with 3+ transfers!",
+                              ("multi_transfer_journeys",), lambda f: f["multi_transfer_journeys"] >= 3))
+register_rule(AchievementRule("Streak Keeper", "You rode transit {longest_streak} days in a row!",
+                              ("longest_streak",), lambda f: f["longest_streak"] >= 7))
+
+
+def required_features(rules: Iterable[AchievementRule] = None) -> Set[str]:
+    """Names of every feature the rules and fun stats need, including dependencies of derived ones"""
+    rules = ACHIEVEMENT_RULES if rules is None else list(rules)
+    pending = set(FUN_STAT_FEATURES).union(*(rule.requires for rule in rules))
+    needed = set()
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.update(FEATURES[name].requires)
+    return needed
+
+
+def compute_features(df: pd.DataFrame, rules: Iterable[AchievementRule] = None) -> Features:
+    """Compute each base feature the rules need once over the parsed frame"""
+    return {
+        name: FEATURES[name].compute(df)
+        for name in sorted(required_features(rules)) if FEATURES[name].is_base
+    }
+
+
+def compute_grouped_features(df: pd.DataFrame, column: str, keys: Iterable[Any],
+                             rules: Iterable[AchievementRule] = None) -> Dict[Any, Features]:
+    """Compute the base features of every card in a merged export, one pass per feature"""
+    empty = df.iloc[:0]
+    features = {key: {} for key in keys}
+    for name in sorted(required_features(rules)):
+        feature = FEATURES[name]
+        if not feature.is_base:
+            continue
+        if feature.compute_grouped is None:
+            values = {key: feature.compute(frame) for key, frame in df.groupby(column, sort=False)}
+        else:
+            values = feature.compute_grouped(df, column)
+        # Cards without matching rows get the value of an empty frame
+        default = None
+        for key, card_features in features.items():
+            if key in values:
+                card_features[name] = values[key]
+            else:
+                if default is None:
+                    default = feature.compute(empty)
+                card_features[name] = default
+    return features
+
+
+def merge_features(a: Features, b: Features) -> Features:
+    """Merge the base features of two shards"""
+    return {name: FEATURES[name].merge(a[name], b[name]) for name in a}
+
+
+def _derive(features: Features, name: str):
+    if name not in features:
+        feature = FEATURES[name]
+        for dependency in feature.requires:
+            _derive(features, dependency)
+        features[name] = feature.derive(features)
+
+
+def evaluate_achievements(base_features: Features, rules: Iterable[AchievementRule] = None) -> Dict[str, Any]:
+    """Evaluate every rule against already computed features"""
+    rules = ACHIEVEMENT_RULES if rules is None else list(rules)
+    features = dict(base_features)
+    for name in required_features(rules):
+        _derive(features, name)
+
+    achievements = []
+    awarded_groups = set()
+    for rule in rules:
+        if rule.group in awarded_groups or not rule.condition(features):
+            continue
+        if rule.group is not None:
+            awarded_groups.add(rule.group)
+        achievements.append({
+            "name": rule.name.format(**features),
+            "description": rule.description.format(**features)
+        })
+
+    earliest_trip = features["earliest_trip"]
+    latest_trip = features["latest_trip"]
+    fun_stats = {
+        "total_trips": features["total_trips"],
+        "earliest_trip": earliest_trip.strftime("%b %d, %Y at %I:%M %p") if earliest_trip is not None else None,
+        "latest_trip": latest_trip.strftime("%b %d, %Y at %I:%M %p") if latest_trip is not None else None,
+        "days_active": features["days_active"],
+        "longest_streak": features["longest_streak"]
+    }
+
+    return {
+        "achievements": achievements,
+        "fun_stats": fun_stats
+    }
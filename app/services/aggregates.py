@@ -0,0 +1,63 @@
+from typing import Dict, Any, Tuple
+import pandas as pd
+
+# Counters that keep the position of each key's first occurrence, so merged
+# counts can be ordered exactly like pandas value_counts() on the full frame
+PositionedCounts = Dict[Any, Tuple[int, Any]]
+
+
+def positioned_counts(values: pd.Series) -> PositionedCounts:
+    """Count values, remembering the index label of each value's first occurrence"""
+    values = values.dropna()
+    if values.empty:
+        return {}
+    grouped = pd.Series(values.index, index=values.values).groupby(level=0, sort=False)
+    sizes = grouped.size()
+    return {
+        key: (int(count), position)
+        for key, count, position in zip(sizes.index, sizes.values, grouped.min().values)
+    }
+
+
+def grouped_positioned_counts(partitions: pd.Series, values: pd.Series) -> Dict[Any, PositionedCounts]:
+    """Positioned counts for every partition in a single groupby"""
+    mask = partitions.notna() & values.notna()
+    frame = pd.DataFrame({
+        'partition': partitions[mask],
+        'value': values[mask],
+        'position': values.index[mask]
+    })
+    grouped = frame.groupby(['partition', 'value'], sort=False)['position'].agg(['size', 'min'])
+
+    counts = {}
+    for (partition, value), count, position in zip(grouped.index, grouped['size'].values, grouped['min'].values):
+        counts.setdefault(partition, {})[value] = (int(count), position)
+    return counts
+
+
+def merge_positioned_counts(a: PositionedCounts, b: PositionedCounts) -> PositionedCounts:
+    merged = dict(a)
+    for key, (count, position) in b.items():
+        if key in merged:
+            merged_count, merged_position = merged[key]
+            merged[key] = (merged_count + count, min(merged_position, position))
+        else:
+            merged[key] = (count, position)
+    return merged
+
+
+def to_value_counts(counts: PositionedCounts) -> pd.Series:
+    """Rebuild the Series value_counts() would have produced on the unsharded data"""
+    if not counts:
+        return pd.Series(dtype=int)
+    ordered = sorted(counts.items(), key=lambda item: item[1][1])
+    result = pd.Series([count for _, (count, _) in ordered], index=[key for key, _ in ordered])
+    return result.sort_values(ascending=False)
+
+
+def min_timestamp(a, b):
+    return pd.Series([a, b], dtype='datetime64[ns]').min()
+
+
+def max_timestamp(a, b):
+    return pd.Series([a, b], dtype='datetime64[ns]').max()
@@ -1,18 +1,48 @@
+import os
 import pandas as pd
+import numpy as np
 import io
 from datetime import datetime, timedelta
 from typing import Dict, List, Any, Tuple
 import re
+import logging
 from ..models import TimePeriod, UserEstimate
+from .achievements import compute_features, evaluate_achievements
+from .upload_cache import upload_cache
+
+logger = logging.getLogger(__name__)
+
+# Journeys outside (TRIP_MIN_MINUTES, TRIP_MAX_MINUTES) are treated as bad taps; overridable per request
+TRIP_MIN_MINUTES = float(os.getenv("TRIP_MIN_MINUTES", "0"))
+TRIP_MAX_MINUTES = float(os.getenv("TRIP_MAX_MINUTES", "240"))
+# Lower edges in minutes of the trip duration histogram buckets; the last bucket is open-ended
+DURATION_HISTOGRAM_EDGES = (0, 10, 20, 30, 45, 60, 90, 120, 180)
+# Missing tap details included in the analysis; the rest are paged by upload_id
+MISSING_TAP_DETAILS_LIMIT = 10
+MISSING_TAP_EVENT_FIELDS = ['journey_id', 'missing_type', 'datetime', 'location']
+# Trip mode by the location type of the journey's first tap in
+TRIP_MODES = {"Bus Stop": "bus", "Station": "station"}
 
 class AnalyticsService:
     def __init__(self):
         pass
     
+    def run_component(self, errors: Dict[str, str], name: str, func, *args) -> Any:
+        """Run one analysis component; with an errors dict, a failure is recorded there and gives None"""
+        if errors is None:
+            return func(*args)
+        try:
+            return func(*args)
+        except Exception as e:
+            errors[name] = str(e)
+            logger.error(f"Error in {name}: {str(e)}", exc_info=logger.isEnabledFor(logging.DEBUG))
+            return None
+    
     def determine_time_period(self, df: pd.DataFrame) -> TimePeriod:
         """Determine the time period of the data"""
-        start_date = df['DateTime'].min()
-        end_date = df['DateTime'].max()
+        return self._build_time_period(df['DateTime'].min(), df['DateTime'].max())
+    
+    def _build_time_period(self, start_date: pd.Timestamp, end_date: pd.Timestamp) -> TimePeriod:
         total_days = (end_date - start_date).days + 1
         
         if total_days <= 7:
@@ -23,15 +53,17 @@ class AnalyticsService:
             period_type = "yearly"
             
         return TimePeriod(
-            start_date=start_date,
-            end_date=end_date,
+            start_date=start_date.isoformat(),
+            end_date=end_date.isoformat(),
             period_type=period_type,
             total_days=total_days
         )
 
     def calculate_user_estimate(self, df: pd.DataFrame, estimated_trips_per_week: int, time_period: TimePeriod) -> UserEstimate:
         """Calculate user estimate accuracy"""
-        total_trips = df['JourneyId'].nunique()
+        return self._build_user_estimate(df['JourneyId'].nunique(), estimated_trips_per_week, time_period)
+    
+    def _build_user_estimate(self, total_trips: int, estimated_trips_per_week: int, time_period: TimePeriod) -> UserEstimate:
         total_weeks = time_period.total_days / 7
         actual_trips_per_week = total_trips / total_weeks
         
@@ -103,13 +135,20 @@ class AnalyticsService:
         """Calculate most traveled routes"""
         # Most used stops (tap in locations)
         tap_ins = df[df['TransactionType'] == 'Tap in']
-        tap_in_counts = tap_ins['LocationName'].value_counts().reset_index()
+        # Most used stations
+        stations = df[df['LocationType'] == 'Station']
+        
+        return self._build_route_stats(
+            tap_ins['LocationName'].value_counts(),
+            stations['LocationName'].value_counts()
+        )
+    
+    def _build_route_stats(self, tap_in_counts: pd.Series, station_counts: pd.Series) -> Dict[str, Any]:
+        tap_in_counts = tap_in_counts.reset_index()
         tap_in_counts.columns = ['location', 'count']
         most_used_stops = tap_in_counts.head(5).to_dict('records')
         
-        # Most used stations
-        stations = df[df['LocationType'] == 'Station']
-        station_counts = stations['LocationName'].value_counts().reset_index()
+        station_counts = station_counts.reset_index()
         station_counts.columns = ['station', 'count']
         most_used_stations = station_counts.head(5).to_dict('records')
         
@@ -118,40 +157,98 @@ class AnalyticsService:
             "most_used_stations": most_used_stations
         }
     
-    def calculate_time_stats(self, df: pd.DataFrame) -> Dict[str, Any]:
+    def calculate_time_stats(self, df: pd.DataFrame, min_trip_minutes: float = None,
+                             max_trip_minutes: float = None) -> Dict[str, Any]:
         """Calculate time-related statistics"""
-        # Group by JourneyId
-        journey_groups = df.groupby('JourneyId')
-        
-        total_time_minutes = 0
-        valid_journeys = 0
+        return self._build_time_stats(self._journey_durations(df), min_trip_minutes, max_trip_minutes)
+    
+    def _journey_keys(self, partition_column: str = None) -> List[str]:
+        """Columns identifying a journey; JourneyIds are only unique within one card"""
+        return [partition_column, 'JourneyId'] if partition_column else ['JourneyId']
+    
+    def _journey_durations(self, df: pd.DataFrame, partition_column: str = None) -> pd.DataFrame:
+        """Minutes from first tap in to last tap out and the mode of each journey, indexed by JourneyId
         
-        for journey_id, journey_df in journey_groups:
-            # Find tap in and tap out for this journey
-            tap_in = journey_df[journey_df['TransactionType'] == 'Tap in']
-            tap_out = journey_df[journey_df['TransactionType'] == 'Tap out']
-            
-            if not tap_in.empty and not tap_out.empty:
-                tap_in_time = tap_in['DateTime'].min()
-                tap_out_time = tap_out['DateTime'].max()
-                
-                # Calculate duration
-                duration = (tap_out_time - tap_in_time).total_seconds() / 60
-                
-                # Only count if journey makes sense (positive duration, not too long)
-                if 0 < duration < 240:  # Less than 4 hours
-                    total_time_minutes += duration
-                    valid_journeys += 1
+        With partition_column, computed for every card at once and indexed by (card, JourneyId).
+        """
+        keys = self._journey_keys(partition_column)
+        tap_ins = df[df['TransactionType'] == 'Tap in']
+        tap_outs = df[df['TransactionType'] == 'Tap out']
+        
+        # The earliest tap in gives both the start time and the mode (NaT sorts last)
+        first_tap_ins = (tap_ins.dropna(subset=keys)
+                         .sort_values('DateTime', kind='stable')
+                         .drop_duplicates(keys)
+                         .set_index(keys))
+        last_tap_outs = tap_outs.groupby(keys)['DateTime'].max()
+        journeys = first_tap_ins[['DateTime', 'LocationType']].join(
+            last_tap_outs.rename('TapOutDateTime'), how='inner'
+        ).sort_index()
+        
+        return pd.DataFrame({
+            'duration': (journeys['TapOutDateTime'] - journeys['DateTime']).dt.total_seconds() / 60,
+            'mode': journeys['LocationType'].map(TRIP_MODES).fillna('other')
+        }, index=journeys.index)
+    
+    def _build_time_stats(self, durations: pd.DataFrame, min_trip_minutes: float = None,
+                          max_trip_minutes: float = None) -> Dict[str, Any]:
+        if min_trip_minutes is None:
+            min_trip_minutes = TRIP_MIN_MINUTES
+        if max_trip_minutes is None:
+            max_trip_minutes = TRIP_MAX_MINUTES
+        
+        # Only count journeys that make sense (positive duration, not too long)
+        valid = durations[(durations['duration'] > min_trip_minutes) & (durations['duration'] < max_trip_minutes)]
+        minutes = valid['duration']
+        valid_journeys = len(minutes)
         
         # Calculate statistics
+        total_time_minutes = float(minutes.sum())
         total_hours = total_time_minutes / 60
         total_days = total_hours / 24
         avg_trip_duration = total_time_minutes / valid_journeys if valid_journeys > 0 else 0
         
+        longest_trip = None
+        if valid_journeys > 0:
+            longest_journey = minutes.idxmax()
+            longest_trip = {
+                "journey_id": longest_journey.strftime("%Y-%m-%d"),
+                "duration": round(float(minutes.loc[longest_journey]), 2)
+            }
+        
+        # Bucket by the histogram's lower edges in one pass
+        edges = np.array(DURATION_HISTOGRAM_EDGES, dtype=float)
+        buckets = np.clip(np.searchsorted(edges, minutes.to_numpy(), side='right') - 1, 0, len(edges) - 1)
+        bucket_counts = np.bincount(buckets, minlength=len(edges))
+        labels = [f"{low}-{high}" for low, high in zip(DURATION_HISTOGRAM_EDGES, DURATION_HISTOGRAM_EDGES[1:])]
+        labels.append(f"{DURATION_HISTOGRAM_EDGES[-1]}+")
+        
+        mode_totals = minutes.groupby(valid['mode']).agg(['sum', 'size'])
+        by_mode = {}
+        for mode in TRIP_MODES.values():
+            mode_minutes, mode_journeys = mode_totals.loc[mode] if mode in mode_totals.index else (0.0, 0)
+            by_mode[mode] = {
+                "journeys": int(mode_journeys),
+                "total_hours": round(mode_minutes / 60, 2),
+                "average_trip_duration": round(mode_minutes / mode_journeys, 2) if mode_journeys > 0 else 0
+            }
+        
         return {
             "total_hours": round(total_hours, 2),
             "total_days": round(total_days, 2),
-            "average_trip_duration": round(avg_trip_duration, 2)
+            "average_trip_duration": round(avg_trip_duration, 2),
+            "median_trip_duration": round(float(minutes.median()), 2) if valid_journeys > 0 else 0,
+            "p90_trip_duration": round(float(minutes.quantile(0.9)), 2) if valid_journeys > 0 else 0,
+            "longest_trip": longest_trip,
+            "duration_histogram": [
+                {"range": label, "count": int(count)} for label, count in zip(labels, bucket_counts)
+            ],
+            "by_mode": by_mode,
+            "outlier_filter": {
+                "min_trip_minutes": min_trip_minutes,
+                "max_trip_minutes": max_trip_minutes,
+                "excluded_journeys": len(durations) - valid_journeys
+            }
         }
     
     def calculate_transfer_stats(self, df: pd.DataFrame) -> Dict[str, Any]:
@@ -159,28 +256,32 @@ class AnalyticsService:
         # Find transfers
         transfers = df[df['TransactionType'] == 'Transfer']
         
+        return self._build_transfer_stats(
+            transfers['LocationName'].value_counts(),
+            self._journey_routes(df).value_counts()
+        )
+    
+    def _journey_routes(self, df: pd.DataFrame, partition_column: str = None) -> pd.Series:
+        """Location sequence of each multi-tap journey, indexed by JourneyId (or card and JourneyId)"""
+        keys = self._journey_keys(partition_column)
+        # Find common journey patterns (tap in -> transfer -> tap out), locations in time order
+        ordered = df.dropna(subset=keys).sort_values(keys + ['DateTime'], kind='stable')
+        journey_ids = [ordered[key] for key in keys]
+        
+        # A string sum per group concatenates far faster than calling join for every journey
+        separator = ' → '
+        routes = (ordered['LocationName'] + separator).groupby(journey_ids, sort=True).sum(min_count=1)
+        routes = routes.str[:-len(separator)]
+        return routes[ordered.groupby(journey_ids, sort=True).size() >= 2].astype(object)
+    
+    def _build_transfer_stats(self, transfer_counts: pd.Series, route_counts: pd.Series) -> Dict[str, Any]:
         # Count transfers by location
-        transfer_counts = transfers['LocationName'].value_counts().reset_index()
+        transfer_counts = transfer_counts.reset_index()
         transfer_counts.columns = ['location', 'count']
         favorite_transfers = transfer_counts.head(5).to_dict('records')
         
-        # Find common journey patterns (tap in -> transfer -> tap out)
-        journey_groups = df.groupby('JourneyId')
-        routes = []
-        
-        for journey_id, journey_df in journey_groups:
-            sorted_journey = journey_df.sort_values('DateTime')
-            
-            if len(sorted_journey) >= 2:
-                # Get locations in order
-                locations = sorted_journey['LocationName'].tolist()
-                
-                if len(locations) > 0:
-                    route = ' → '.join(locations)
-                    routes.append(route)
-        
         # Count common routes
-        route_counts = pd.Series(routes).value_counts().reset_index()
+        route_counts = route_counts.reset_index()
         route_counts.columns = ['route', 'count']
         common_routes = route_counts.head(5).to_dict('records')
         
@@ -194,12 +295,16 @@ class AnalyticsService:
         # Time-based personality
         tap_ins = df[df['TransactionType'] == 'Tap in']
         
-        # Extract hour of day
-        tap_ins['hour'] = tap_ins['DateTime'].dt.hour
-        
-        # Count trips by hour
-        hour_counts = tap_ins['hour'].value_counts().to_dict()
+        # Count trips by hour of day
+        hour_counts = tap_ins['DateTime'].dt.hour.value_counts().to_dict()
         
+        return self._build_personality(
+            hour_counts,
+            df['LocationName'].value_counts(),
+            df['JourneyId'].nunique()
+        )
+    
+    def _build_personality(self, hour_counts: Dict[int, int], common_locations: pd.Series, unique_journeys: int) -> Dict[str, Any]:
         # Define time ranges
         morning_trips = sum(hour_counts.get(h, 0) for h in range(5, 12))  # 5 AM - noon
         afternoon_trips = sum(hour_counts.get(h, 0) for h in range(12, 17))  # noon - 5 PM
@@ -232,8 +337,7 @@ class AnalyticsService:
                 time_description = f"You're a Night Rider—{int(night_pct*100)}% of your trips happen at night!"
         
         # Location-based personality
-        location_counts = df['LocationName'].nunique()
-        common_locations = df['LocationName'].value_counts()
+        location_counts = len(common_locations)
         most_common_location_count = common_locations.max() if not common_locations.empty else 0
         most_common_location = common_locations.idxmax() if not common_locations.empty else "Unknown"
         
@@ -241,12 +345,10 @@ class AnalyticsService:
         location_personality = "Regular Commuter"
         location_description = "You have a balanced mix of locations."
         
-        unique_journeys = df['JourneyId'].nunique()
-        
         if location_counts > 20 and unique_journeys > 30:
             location_personality = "City Explorer"
             location_description = f"You're a City Explorer with {location_counts} different locations visited!"
-        elif most_common_location_count > 0.6 * df['JourneyId'].nunique():
+        elif most_common_location_count > 0.6 * unique_journeys:
             location_personality = "Vanilla Commuter"
             location_description = f"You're a Vanilla Commuter—you frequently visit {most_common_location}!"
         elif unique_journeys < 10:
@@ -275,122 +377,127 @@ class AnalyticsService:
     
     def calculate_achievements(self, df: pd.DataFrame) -> Dict[str, Any]:
         """Calculate achievements and fun stats"""
-        achievements = []
-        total_trips = df['JourneyId'].nunique()
-        
-        # Trip milestones
-        if total_trips >= 300:
-            achievements.append({
-                "name": "Transit Veteran",
-                "description": f"You took {total_trips} trips this year!"
-            })
-        elif total_trips >= 100:
-            achievements.append({
-                "name": "Regular Commuter",
-                "description": f"You took {total_trips} trips this year!"
-            })
-        elif total_trips >= 50:
-            achievements.append({
-                "name": "Transit Enthusiast",
-                "description": f"You took {total_trips} trips this year!"
-            })
-        
-        # Most used route
-        routes = df['Transaction'].str.extract(r'(\d+)').dropna()
-        if not routes.empty:
-            route_counts = routes[0].value_counts()
-            if not route_counts.empty:
-                most_used_route = route_counts.index[0]
-                route_count = route_counts.iloc[0]
-                achievements.append({
-                    "name": f"R{most_used_route} Warrior",
-                    "description": f"You used the R{most_used_route} route {route_count} times!"
-                })
-        
-        # Multi-transfer journeys
-        journey_groups = df.groupby('JourneyId')
-        multi_transfer_count = 0
-        
-        for journey_id, journey_df in journey_groups:
-            transfers = journey_df[journey_df['TransactionType'] == 'Transfer']
-            if len(transfers) >= 3:
-                multi_transfer_count += 1
-                
-        if multi_transfer_count >= 3:
-            achievements.append({
-                "name": "Multi-Transfer Master",
-                "description": f"You made {multi_transfer_count} journeys with 3+ transfers!"
-            })
-        
-        # Fun stats
-        earliest_trip = df['DateTime'].min() if not df.empty else None
-        latest_trip = df['DateTime'].max() if not df.empty else None
-        
-        fun_stats = {
-            "total_trips": total_trips,
-            "earliest_trip": earliest_trip.strftime("%b %d, %Y at %I:%M %p") if earliest_trip is not None else None,
-            "latest_trip": latest_trip.strftime("%b %d, %Y at %I:%M %p") if latest_trip is not None else None,
-            "days_active": (latest_trip - earliest_trip).days + 1 if earliest_trip is not None and latest_trip is not None else 0
-        }
-        
-        return {
-            "achievements": achievements,
-            "fun_stats": fun_stats
-        }
-        
-    def find_missing_taps(self, df: pd.DataFrame) -> Dict[str, Any]:
-        """Find missing tap-ins and tap-outs"""
-        journey_groups = df.groupby('JourneyId')
-        
-        missing_tap_ins = 0
-        missing_tap_outs = 0
-        missing_details = []
-        
-        for journey_id, journey_df in journey_groups:
-            has_tap_in = any(journey_df['TransactionType'] == 'Tap in')
-            has_tap_out = any(journey_df['TransactionType'] == 'Tap out')
-            
-            if not has_tap_in and not has_tap_out:
-                # Skip journeys with neither tap in nor tap out (probably just transfers)
-                continue
-                
-            if not has_tap_in:
-                missing_tap_ins += 1
-                first_event = journey_df.iloc[0]
-                missing_details.append({
-                    "journey_id": journey_id.strftime("%Y-%m-%d") if not pd.isna(journey_id) else "Unknown",
-                    "missing_type": "Tap in",
-                    "datetime": first_event['DateTime'].strftime("%b %d, %Y at %I:%M %p") if not pd.isna(first_event['DateTime']) else "Unknown",
-                    "location": first_event['LocationName']
-                })
-            
-            if not has_tap_out:
-                missing_tap_outs += 1
-                last_event = journey_df.iloc[-1]
-                missing_details.append({
-                    "journey_id": journey_id.strftime("%Y-%m-%d") if not pd.isna(journey_id) else "Unknown",
-                    "missing_type": "Tap out",
-                    "datetime": last_event['DateTime'].strftime("%b %d, %Y at %I:%M %p") if not pd.isna(last_event['DateTime']) else "Unknown",
-                    "location": last_event['LocationName']
-                })
+        return self._build_achievements(compute_features(df))
+    
+    def _build_achievements(self, features: Dict[str, Any]) -> Dict[str, Any]:
+        # Rules live in the achievements registry; features were computed once for all of them
+        return evaluate_achievements(features)
+        
+    def build_journey_flags(self, df: pd.DataFrame, partition_column: str = None) -> pd.DataFrame:
+        """Build a per-journey table of tap flags and first/last events, sorted by JourneyId"""
+        keys = self._journey_keys(partition_column)
+        journeys = df.dropna(subset=keys)
+        journey_ids = [journeys[key] for key in keys]
+        
+        flags = pd.DataFrame({
+            'has_tap_in': (journeys['TransactionType'] == 'Tap in').groupby(journey_ids).any(),
+            'has_tap_out': (journeys['TransactionType'] == 'Tap out').groupby(journey_ids).any()
+        })
+        
+        # First and last rows of each journey in file order
+        first_events = journeys.drop_duplicates(keys, keep='first').set_index(keys)
+        last_events = journeys.drop_duplicates(keys, keep='last').set_index(keys)
+        flags['first_datetime'] = first_events['DateTime']
+        flags['first_location'] = first_events['LocationName']
+        flags['last_datetime'] = last_events['DateTime']
+        flags['last_location'] = last_events['LocationName']
+        
+        return flags
+    
+    def _missing_tap_event_frame(self, df: pd.DataFrame, partition_column: str = None) -> pd.DataFrame:
+        """One row per missing tap-in or tap-out, ordered by journey"""
+        keys = self._journey_keys(partition_column)
+        flags = self.build_journey_flags(df, partition_column)
+        # Skip journeys with neither tap in nor tap out (probably just transfers)
+        flags = flags[flags['has_tap_in'] | flags['has_tap_out']]
+        
+        missing_in = flags[~flags['has_tap_in']].reset_index()
+        missing_out = flags[~flags['has_tap_out']].reset_index()
+        events = pd.concat([
+            missing_in[keys].assign(
+                order=0,
+                missing_type='Tap in',
+                datetime=missing_in['first_datetime'],
+                location=missing_in['first_location']
+            ),
+            missing_out[keys].assign(
+                order=1,
+                missing_type='Tap out',
+                datetime=missing_out['last_datetime'],
+                location=missing_out['last_location']
+            )
+        ], ignore_index=True).sort_values(keys + ['order'], kind='stable')
+        
+        events['journey_id'] = events['JourneyId'].dt.strftime("%Y-%m-%d").fillna("Unknown")
+        events['datetime'] = pd.to_datetime(events['datetime']).dt.strftime("%b %d, %Y at %I:%M %p").fillna("Unknown")
+        events['location'] = events['location'].astype(object).where(events['location'].notna(), None)
+        return events
+    
+    def list_missing_tap_events(self, df: pd.DataFrame) -> List[Dict[str, Any]]:
+        """List every missing tap-in and tap-out event, ordered by journey"""
+        events = self._missing_tap_event_frame(df)
+        return events[MISSING_TAP_EVENT_FIELDS].to_dict('records')
+    
+    def find_missing_taps(self, df: pd.DataFrame, upload_id: str = None,
+                          missing_tap_events: List[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Find missing tap-ins and tap-outs
+        
+        Pass missing_tap_events to reuse an already computed event list, and
+        upload_id to cache it so clients can page through the rest.
+        """
+        if missing_tap_events is None:
+            missing_tap_events = self.list_missing_tap_events(df)
+        return self._build_missing_taps(missing_tap_events, upload_id)
+    
+    def _build_missing_taps(self, missing_details: List[Dict[str, Any]], upload_id: str = None) -> Dict[str, Any]:
+        if upload_id:
+            upload_cache.set(upload_id, "missing_tap_events", missing_details)
+        missing_tap_ins = sum(1 for detail in missing_details if detail['missing_type'] == 'Tap in')
+        has_more = len(missing_details) > MISSING_TAP_DETAILS_LIMIT
         
         return {
             "missing_tap_ins": missing_tap_ins,
-            "missing_tap_outs": missing_tap_outs,
-            "details": missing_details[:10]  # Limit to 10 details
+            "missing_tap_outs": len(missing_details) - missing_tap_ins,
+            "details": missing_details[:MISSING_TAP_DETAILS_LIMIT],
+            # Cursor for GET /analytics/missing-taps/{upload_id}
+            "upload_id": upload_id,
+            "next_cursor": str(MISSING_TAP_DETAILS_LIMIT) if upload_id and has_more else None
         }
     
-    def generate_compass_wrapped(self, df: pd.DataFrame, estimated_trips_per_week: int = None) -> Dict[str, Any]:
-        """Generate complete Compass Wrapped analysis"""
+    def generate_compass_wrapped(self, df: pd.DataFrame, estimated_trips_per_week: int = None,
+                                 shards: int = None, min_trip_minutes: float = None,
+                                 max_trip_minutes: float = None, upload_id: str = None,
+                                 missing_tap_events: List[Dict[str, Any]] = None,
+                                 errors: Dict[str, str] = None) -> Dict[str, Any]:
+        """Generate complete Compass Wrapped analysis
+        
+        With more than one shard, journeys are partitioned by JourneyId range and
+        analyzed across a process pool. Defaults to sharding only very large uploads.
+        Trips outside (min_trip_minutes, max_trip_minutes) are left out of time_stats.
+        upload_id and missing_tap_events are passed on to find_missing_taps; in sharded
+        mode the events come from the shards instead of a separate pass. With an
+        errors dict, a failing component is recorded there and returned as None.
+        """
+        from .sharded_analysis import default_shard_count, compute_partials, build_wrapped_from_partial
+        
+        if shards is None:
+            shards = default_shard_count(len(df))
+        if shards > 1:
+            partial = compute_partials(df, shards)
+            return build_wrapped_from_partial(self, partial, estimated_trips_per_week,
+                                              min_trip_minutes, max_trip_minutes,
+                                              upload_id, missing_tap_events, errors)
+        
         time_period = self.determine_time_period(df)
         
-        total_stats = self.calculate_total_stats(df)
-        route_stats = self.calculate_route_stats(df)
-        time_stats = self.calculate_time_stats(df)
-        transfer_stats = self.calculate_transfer_stats(df)
-        personality = self.determine_personality(df)
-        achievements = self.calculate_achievements(df)
-        missing_taps = self.find_missing_taps(df)
+        run = self.run_component
+        total_stats = run(errors, "total_stats", self.calculate_total_stats, df)
+        route_stats = run(errors, "route_stats", self.calculate_route_stats, df)
+        time_stats = run(errors, "time_stats", self.calculate_time_stats, df, min_trip_minutes, max_trip_minutes)
+        transfer_stats = run(errors, "transfer_stats", self.calculate_transfer_stats, df)
+        personality = run(errors, "personality", self.determine_personality, df)
+        achievements = run(errors, "achievements", self.calculate_achievements, df)
+        missing_taps = run(errors, "missing_taps", self.find_missing_taps, df, upload_id, missing_tap_events)
         
         user_estimate = None
         if estimated_trips_per_week is not None:
@@ -406,4 +513,50 @@ class AnalyticsService:
             "achievements": achievements,
             "missing_taps": missing_taps,
             "user_estimate": user_estimate.dict() if user_estimate else None
-        } 
\ No newline at end of file
+        } 
+    
+    def generate_partitioned_wrapped(self, df: pd.DataFrame, partition_column: str,
+                                     estimated_trips_per_week: int = None, min_trip_minutes: float = None,
+                                     max_trip_minutes: float = None, errors: Dict[str, str] = None) -> Dict[str, Any]:
+        """Generate one Compass Wrapped analysis per card/user in a merged export
+        
+        Each partition is ranked against the others with the same percentile and
+        personality logic used for stored user stats. Component failures are
+        recorded in errors as "<partition>.<component>". Rows without a value in
+        partition_column belong to no partition; their count is returned as
+        unpartitioned_rows.
+        """
+        from .sharded_analysis import compute_partition_partials, build_wrapped_from_partial
+        from .user_stats_service import UserStatsService
+        
+        partitions = []
+        for key, partial in compute_partition_partials(df, partition_column).items():
+            partition_errors = {} if errors is not None else None
+            wrapped = build_wrapped_from_partial(self, partial, estimated_trips_per_week,
+                                                 min_trip_minutes, max_trip_minutes, errors=partition_errors)
+            if partition_errors:
+                errors.update({f"{key}.{name}": message for name, message in partition_errors.items()})
+            partitions.append({"partition": str(key), **wrapped})
+        
+        all_trips_per_week = [
+            p["total_stats"]["total_journeys"] / (p["time_period"]["total_days"] / 7)
+            for p in partitions
+        ]
+        for wrapped, trips_per_week in zip(partitions, all_trips_per_week):
+            comparison = UserStatsService.build_comparison_stats(
+                trips_per_week,
+                UserStatsService.calculate_percentile(trips_per_week, all_trips_per_week),
+                estimated_trips_per_week
+            )
+            estimate_accuracy = wrapped["user_estimate"]["accuracy_percentage"] if wrapped["user_estimate"] else None
+            wrapped["comparison"] = comparison.dict()
+            wrapped["transit_personality"] = UserStatsService.determine_personality(
+                comparison.percentile,
+                estimate_accuracy
+            ).dict()
+        
+        return {
+            "partition_column": partition_column,
+            "partitions": partitions,
+            "unpartitioned_rows": int(df[partition_column].isna().sum())
+        }
@@ -0,0 +1,49 @@
+import os
+import signal
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_MAX_WORKERS = int(os.getenv("ANALYTICS_MAX_WORKERS", str(os.cpu_count() or 1)))
+# Forking the threaded server process can deadlock on locks held by other threads
+ANALYTICS_POOL_START_METHOD = os.getenv("ANALYTICS_POOL_START_METHOD", "spawn")
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _ignore_interrupts():
+    # Ctrl-C reaches the whole process group; the app's shutdown hook stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """The shared pool for sharded analysis, created on first use
+
+    Workers are started on demand and kept for later requests, so only the
+    first sharded analysis pays for starting them.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=max(1, ANALYTICS_MAX_WORKERS),
+                mp_context=multiprocessing.get_context(ANALYTICS_POOL_START_METHOD),
+                initializer=_ignore_interrupts
+            )
+            logger.info(f"Started analytics process pool ({ANALYTICS_POOL_START_METHOD}, "
+                        f"up to {ANALYTICS_MAX_WORKERS} workers)")
+        return _pool
+
+
+def shutdown_process_pool():
+    """Stop the shared pool's workers; a later sharded analysis starts a new pool"""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,215 @@
+import os
+from collections import Counter
+from functools import reduce
+from typing import Dict, List, Any
+import numpy as np
+import pandas as pd
+
+from .aggregates import (
+    positioned_counts, grouped_positioned_counts, merge_positioned_counts, to_value_counts,
+    min_timestamp, max_timestamp
+)
+from .achievements import compute_features, compute_grouped_features, merge_features
+from .analytics_service import AnalyticsService, MISSING_TAP_EVENT_FIELDS
+from .process_pool import ANALYTICS_MAX_WORKERS, get_process_pool
+
+# Uploads with at least this many rows are analyzed in sharded mode by default
+ANALYTICS_SHARD_MIN_ROWS = int(os.getenv("ANALYTICS_SHARD_MIN_ROWS", "1000000"))
+
+COUNTER_KEYS = (
+    "tap_in_locations",
+    "station_locations",
+    "transfer_locations",
+    "all_locations",
+    "journey_routes",
+)
+
+
+def default_shard_count(rows: int) -> int:
+    """Number of shards to use for an upload of the given size"""
+    if rows < ANALYTICS_SHARD_MIN_ROWS:
+        return 1
+    return max(1, ANALYTICS_MAX_WORKERS)
+
+
+def split_into_shards(df: pd.DataFrame, num_shards: int) -> List[pd.DataFrame]:
+    """Partition rows into contiguous JourneyId ranges so no journey spans two shards"""
+    # .values gives plain datetime64 (UTC) even for tz-aware JourneyIds
+    journey_values = df['JourneyId'].values
+    journey_ids = np.unique(journey_values[~pd.isna(journey_values)])
+    if num_shards <= 1 or len(journey_ids) <= 1:
+        return [df]
+
+    range_starts = np.array([ids[0] for ids in np.array_split(journey_ids, min(num_shards, len(journey_ids)))])
+    # Rows without a JourneyId (NaT) sort past every range start and land in the last shard
+    shard_codes = np.searchsorted(range_starts, journey_values, side='right') - 1
+    shard_codes = np.clip(shard_codes, 0, len(range_starts) - 1)
+    return [shard for _, shard in df.groupby(shard_codes, sort=True)]
+
+
+def _journey_partial(service, frame: pd.DataFrame) -> Dict[str, Any]:
+    """Partial aggregates that need whole journeys"""
+    return {
+        # Indexed by JourneyId, so the first-occurrence position follows journey order
+        "journey_routes": positioned_counts(service._journey_routes(frame)),
+        # Kept per journey so medians, percentiles and thresholds apply after merging
+        "journey_durations": service._journey_durations(frame),
+        "achievement_features": compute_features(frame),
+        "missing_tap_events": service.list_missing_tap_events(frame),
+    }
+
+
+def compute_shard_partial(shard: pd.DataFrame) -> Dict[str, Any]:
+    """Compute the partial aggregates for one shard of parsed data"""
+    service = AnalyticsService()
+    tap_ins = shard[shard['TransactionType'] == 'Tap in']
+
+    return {
+        "rows": len(shard),
+        "total_journeys": int(shard['JourneyId'].nunique()),
+        "min_datetime": shard['DateTime'].min(),
+        "max_datetime": shard['DateTime'].max(),
+        "tap_in_locations": positioned_counts(tap_ins['LocationName']),
+        "station_locations": positioned_counts(shard.loc[shard['LocationType'] == 'Station', 'LocationName']),
+        "transfer_locations": positioned_counts(shard.loc[shard['TransactionType'] == 'Transfer', 'LocationName']),
+        "all_locations": positioned_counts(shard['LocationName']),
+        "tap_in_hours": Counter(tap_ins['DateTime'].dt.hour.dropna().astype(int).tolist()),
+        **_journey_partial(service, shard),
+    }
+
+
+def compute_partition_partials(df: pd.DataFrame, column: str) -> Dict[Any, Dict[str, Any]]:
+    """Compute a partial for each value of column (e.g. one per card) from one parsed frame
+
+    Rows whose column value is missing belong to no partition and are left out.
+    """
+    service = AnalyticsService()
+    partitions = df[column]
+    is_tap_in = df['TransactionType'] == 'Tap in'
+
+    # Row-level aggregates are computed once across all partitions
+    summary = df.groupby(column).agg(
+        rows=('JourneyId', 'size'),
+        total_journeys=('JourneyId', 'nunique'),
+        min_datetime=('DateTime', 'min'),
+        max_datetime=('DateTime', 'max')
+    )
+    counters = {
+        "tap_in_locations": grouped_positioned_counts(partitions[is_tap_in], df.loc[is_tap_in, 'LocationName']),
+        "station_locations": grouped_positioned_counts(
+            partitions[df['LocationType'] == 'Station'], df.loc[df['LocationType'] == 'Station', 'LocationName']
+        ),
+        "transfer_locations": grouped_positioned_counts(
+            partitions[df['TransactionType'] == 'Transfer'], df.loc[df['TransactionType'] == 'Transfer', 'LocationName']
+        ),
+        "all_locations": grouped_positioned_counts(partitions, df['LocationName']),
+    }
+    hour_counts = df.loc[is_tap_in].groupby([partitions[is_tap_in], df.loc[is_tap_in, 'DateTime'].dt.hour]).size()
+    tap_in_hours = {}
+    for (key, hour), count in hour_counts.items():
+        tap_in_hours.setdefault(key, Counter())[int(hour)] = int(count)
+
+    # Journey-level aggregates are computed once over (card, JourneyId), then split per card
+    journey_routes = service._journey_routes(df, column)
+    journey_ids = journey_routes.index.get_level_values(1)
+    route_counts = grouped_positioned_counts(
+        # Positioned by JourneyId, so ties follow journey order as for a single card
+        pd.Series(journey_routes.index.get_level_values(0), index=journey_ids),
+        pd.Series(journey_routes.to_numpy(), index=journey_ids, dtype=object)
+    )
+    durations = service._journey_durations(df, column)
+    card_durations = {key: frame.droplevel(0) for key, frame in durations.groupby(level=0, sort=False)}
+    no_durations = durations.iloc[:0].droplevel(0)
+    events = service._missing_tap_event_frame(df, column)
+    card_events = {
+        key: frame[MISSING_TAP_EVENT_FIELDS].to_dict('records') for key, frame in events.groupby(column, sort=False)
+    }
+    card_features = compute_grouped_features(df, column, summary.index)
+
+    partials = {}
+    for key, row in summary.iterrows():
+        partial = {
+            "rows": int(row['rows']),
+            "total_journeys": int(row['total_journeys']),
+            "min_datetime": row['min_datetime'],
+            "max_datetime": row['max_datetime'],
+            "tap_in_hours": tap_in_hours.get(key, Counter()),
+            "journey_routes": route_counts.get(key, {}),
+            "journey_durations": card_durations.get(key, no_durations),
+            "achievement_features": card_features[key],
+            "missing_tap_events": card_events.get(key, []),
+        }
+        for name, counts in counters.items():
+            partial[name] = counts.get(key, {})
+        partials[key] = partial
+    return partials
+
+
+def merge_partials(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+    """Associative reduce of two shard partials; a must cover earlier journeys than b"""
+    merged = {
+        "rows": a["rows"] + b["rows"],
+        "total_journeys": a["total_journeys"] + b["total_journeys"],
+        "min_datetime": min_timestamp(a["min_datetime"], b["min_datetime"]),
+        "max_datetime": max_timestamp(a["max_datetime"], b["max_datetime"]),
+        "tap_in_hours": a["tap_in_hours"] + b["tap_in_hours"],
+        "journey_durations": pd.concat([a["journey_durations"], b["journey_durations"]]),
+        "achievement_features": merge_features(a["achievement_features"], b["achievement_features"]),
+        "missing_tap_events": a["missing_tap_events"] + b["missing_tap_events"],
+    }
+    for key in COUNTER_KEYS:
+        merged[key] = merge_positioned_counts(a[key], b[key])
+    return merged
+
+
+def compute_partials(df: pd.DataFrame, num_shards: int) -> Dict[str, Any]:
+    """Split the data into shards, compute partials in the shared process pool and reduce them"""
+    shards = split_into_shards(df, num_shards)
+    if len(shards) == 1:
+        return compute_shard_partial(shards[0])
+
+    # map() keeps shard order, which the reduce relies on for list results
+    partials = list(get_process_pool().map(compute_shard_partial, shards))
+    return reduce(merge_partials, partials)
+
+
+def build_wrapped_from_partial(service, partial: Dict[str, Any], estimated_trips_per_week: int = None,
+                               min_trip_minutes: float = None, max_trip_minutes: float = None,
+                               upload_id: str = None, missing_tap_events: List[Dict[str, Any]] = None,
+                               errors: Dict[str, str] = None) -> Dict[str, Any]:
+    """Turn a fully reduced partial into the same result as generate_compass_wrapped"""
+    if missing_tap_events is None:
+        missing_tap_events = partial["missing_tap_events"]
+    time_period = service._build_time_period(partial["min_datetime"], partial["max_datetime"])
+
+    user_estimate = None
+    if estimated_trips_per_week is not None:
+        user_estimate = service._build_user_estimate(partial["total_journeys"], estimated_trips_per_week, time_period)
+
+    run = service.run_component
+    return {
+        "time_period": time_period.dict(),
+        "total_stats": {
+            "total_taps": partial["rows"],
+            "total_journeys": partial["total_journeys"]
+        },
+        "route_stats": run(errors, "route_stats", lambda: service._build_route_stats(
+            to_value_counts(partial["tap_in_locations"]),
+            to_value_counts(partial["station_locations"])
+        )),
+        "time_stats": run(errors, "time_stats", lambda: service._build_time_stats(
+            partial["journey_durations"], min_trip_minutes, max_trip_minutes
+        )),
+        "transfer_stats": run(errors, "transfer_stats", lambda: service._build_transfer_stats(
+            to_value_counts(partial["transfer_locations"]),
+            to_value_counts(partial["journey_routes"])
+        )),
+        "personality": run(errors, "personality", lambda: service._build_personality(
+            dict(partial["tap_in_hours"]),
+            to_value_counts(partial["all_locations"]),
+            partial["total_journeys"]
+        )),
+        "achievements": run(errors, "achievements", service._build_achievements, partial["achievement_features"]),
+        "missing_taps": run(errors, "missing_taps", service._build_missing_taps, missing_tap_events, upload_id),
+        "user_estimate": user_estimate.dict() if user_estimate else None
+    }
@@ -0,0 +1,114 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+import logging
+
+from ..models import UserStatsResponse
+
+logger = logging.getLogger(__name__)
+
+STATS_CACHE_MAX_SIZE = int(os.getenv("STATS_CACHE_MAX_SIZE", "1024"))
+STATS_CACHE_TTL_SECONDS = float(os.getenv("STATS_CACHE_TTL_SECONDS", "300"))
+# Relative change in the trips-per-week distribution that invalidates cached percentiles
+STATS_CACHE_SHIFT_THRESHOLD = float(os.getenv("STATS_CACHE_SHIFT_THRESHOLD", "0.05"))
+
+
+class StatsCache:
+    """In-memory TTL/LRU cache of computed UserStatsResponse objects keyed by user_id"""
+
+    def __init__(self, max_size: int = STATS_CACHE_MAX_SIZE, ttl_seconds: float = STATS_CACHE_TTL_SECONDS,
+                 shift_threshold: float = STATS_CACHE_SHIFT_THRESHOLD):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.shift_threshold = shift_threshold
+        # user_id -> (expires_at, period_type, (count, mean) snapshot, response)
+        self._entries: "OrderedDict[str, Tuple[float, str, Tuple[int, float], UserStatsResponse]]" = OrderedDict()
+        # period_type -> [count, sum of trips per week]
+        self._distributions: Dict[str, list] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _snapshot(self, period_type: str) -> Tuple[int, float]:
+        count, total = self._distributions.get(period_type, (0, 0.0))
+        return count, (total / count if count else 0.0)
+
+    def _has_shifted(self, period_type: str, snapshot: Tuple[int, float]) -> bool:
+        old_count, old_mean = snapshot
+        count, mean = self._snapshot(period_type)
+        if old_count == 0:
+            return count > 0
+        if count - old_count > self.shift_threshold * old_count:
+            return True
+        if old_mean and abs(mean - old_mean) / old_mean > self.shift_threshold:
+            return True
+        return False
+
+    def get(self, user_id: str) -> Optional[UserStatsResponse]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, period_type, snapshot, response = entry
+        if time.monotonic() >= expires_at or self._has_shifted(period_type, snapshot):
+            del self._entries[user_id]
+            self.invalidations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return response
+
+    def set(self, user_id: str, response: UserStatsResponse):
+        if self.max_size <= 0:
+            return
+        period_type = response.stats.time_period.period_type
+        self._entries[user_id] = (
+            time.monotonic() + self.ttl_seconds,
+            period_type,
+            self._snapshot(period_type),
+            response
+        )
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id: str):
+        if self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def observe_distribution(self, period_type: str, count: int, total_trips_per_week: float):
+        """Record the full distribution seen by a percentile query"""
+        self._distributions[period_type] = [count, total_trips_per_week]
+
+    def record_write(self, period_type: str, trips_per_week: float):
+        """Fold a newly saved sample into the tracked distribution"""
+        distribution = self._distributions.setdefault(period_type, [0, 0.0])
+        distribution[0] += 1
+        distribution[1] += trips_per_week
+
+    def clear(self):
+        self._entries.clear()
+        self._distributions.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations
+        }
+
+
+# Shared across requests; UserStatsService is created per request
+stats_cache = StatsCache()
@@ -0,0 +1,111 @@
+import os
+import time
+import asyncio
+from typing import Dict, List, Any, Optional, Callable, Awaitable
+import logging
+
+logger = logging.getLogger(__name__)
+
+# "buffered" acknowledges writes from memory, "sync" waits for Mongo on every write
+STATS_WRITE_MODE = os.getenv("STATS_WRITE_MODE", "buffered")
+STATS_BUFFER_MAX_BATCH = int(os.getenv("STATS_BUFFER_MAX_BATCH", "100"))
+STATS_BUFFER_FLUSH_INTERVAL_SECONDS = float(os.getenv("STATS_BUFFER_FLUSH_INTERVAL_SECONDS", "2"))
+
+BatchWriter = Callable[[List[Dict[str, Any]]], Awaitable[None]]
+
+
+class StatsWriteBuffer:
+    """Write-behind buffer that batches user stats writes into bulk upserts"""
+
+    def __init__(self, max_batch: int = STATS_BUFFER_MAX_BATCH,
+                 flush_interval: float = STATS_BUFFER_FLUSH_INTERVAL_SECONDS):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.writer: Optional[BatchWriter] = None
+        self._pending: List[Dict[str, Any]] = []
+        # Documents handed to the writer but not yet confirmed
+        self._in_flight: List[Dict[str, Any]] = []
+        self._oldest_pending_at: Optional[float] = None
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+
+    async def add(self, writer: BatchWriter, document: Dict[str, Any]):
+        """Queue a document; writer must be idempotent since failed batches are retried"""
+        self.writer = writer
+        if not self._pending:
+            self._oldest_pending_at = time.monotonic()
+        self._pending.append(document)
+
+        # Size threshold, plus a time check for deployments where the background flusher can't run
+        if len(self._pending) >= self.max_batch or self._is_overdue():
+            await self.flush()
+
+    def _is_overdue(self) -> bool:
+        return (self._oldest_pending_at is not None
+                and time.monotonic() - self._oldest_pending_at >= self.flush_interval)
+
+    def pending_documents(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Unconfirmed documents matching a Mongo-style equality query on dotted paths"""
+        return [
+            doc for doc in self._in_flight + self._pending
+            if all(self._get_path(doc, path) == value for path, value in query.items())
+        ]
+
+    @staticmethod
+    def _get_path(document: Dict[str, Any], path: str) -> Any:
+        value = document
+        for key in path.split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending or self.writer is None:
+                return
+            batch = self._pending
+            self._pending = []
+            self._oldest_pending_at = None
+            self._in_flight = batch
+
+            try:
+                await self.writer(batch)
+                logger.info(f"Flushed {len(batch)} buffered user stats")
+            except asyncio.CancelledError:
+                self._requeue(batch)
+                raise
+            except Exception as e:
+                logger.error(f"Error flushing buffered user stats, retrying later: {e}")
+                self._requeue(batch)
+            finally:
+                self._in_flight = []
+
+    def _requeue(self, documents: List[Dict[str, Any]]):
+        self._pending = documents + self._pending
+        self._oldest_pending_at = time.monotonic()
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Background stats flush failed: {e}")
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.get_running_loop().create_task(self._run_flusher())
+
+    async def close(self):
+        """Stop the background flusher and write out everything still pending"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+
+# Shared across requests; started and flushed by the app's startup/shutdown hooks
+stats_write_buffer = StatsWriteBuffer()
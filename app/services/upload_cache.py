@@ -0,0 +1,54 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+UPLOAD_CACHE_MAX_SIZE = int(os.getenv("UPLOAD_CACHE_MAX_SIZE", "32"))
+UPLOAD_CACHE_TTL_SECONDS = float(os.getenv("UPLOAD_CACHE_TTL_SECONDS", "900"))
+
+
+def compute_upload_id(contents: bytes) -> str:
+    """Identify an upload by the hash of its raw contents"""
+    return hashlib.sha256(contents).hexdigest()
+
+
+class UploadResultCache:
+    """In-memory TTL/LRU cache of analysis results keyed by upload content hash"""
+
+    def __init__(self, max_size: int = UPLOAD_CACHE_MAX_SIZE, ttl_seconds: float = UPLOAD_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # upload_id -> (expires_at, {result name: value})
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # Analyses fill the cache from worker threads
+        self._lock = threading.Lock()
+
+    def get(self, upload_id: str, name: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(upload_id)
+            if entry is None:
+                return None
+            expires_at, results = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[upload_id]
+                return None
+            self._entries.move_to_end(upload_id)
+            return results.get(name)
+
+    def set(self, upload_id: str, name: str, value: Any):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            entry = self._entries.get(upload_id)
+            results = entry[1] if entry else {}
+            results[name] = value
+            self._entries[upload_id] = (time.monotonic() + self.ttl_seconds, results)
+            self._entries.move_to_end(upload_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+# Shared across requests so follow-up pages reuse earlier results
+upload_cache = UploadResultCache()
@@ -1,19 +1,162 @@
-from datetime import datetime
-from typing import List, Optional
+import os
+import asyncio
+from datetime import datetime, timezone
+from typing import List, Optional, Dict, Any, Tuple
 from ..models import UserStats, TransitPersonality, UserStatsResponse, ComparisonStats
-import numpy as np
 from motor.motor_asyncio import AsyncIOMotorClient
-from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+from .stats_cache import stats_cache
+from .stats_write_buffer import stats_write_buffer, STATS_WRITE_MODE
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Superseded snapshots kept per (user_id, period_type, start_date) in user_stats_history
+STATS_HISTORY_MAX_SNAPSHOTS = int(os.getenv("STATS_HISTORY_MAX_SNAPSHOTS", "20"))
+
+# Server-side equivalent of total_trips / (total_days / 7)
+TRIPS_PER_WEEK_EXPR = {"$divide": ["$total_trips", {"$divide": ["$time_period.total_days", 7]}]}
+
 class UserStatsService:
     def __init__(self, db_client: AsyncIOMotorClient):
         self.db = db_client.compass_wrapped
         self.stats_collection = self.db.user_stats
+        self.history_collection = self.db.user_stats_history
+        self.cache = stats_cache
+        self.write_buffer = stats_write_buffer
+
+    async def ensure_indexes(self):
+        try:
+            await self.stats_collection.create_index(
+                [("user_id", 1), ("time_period.period_type", 1), ("time_period.start_date", 1)],
+                unique=True,
+                name="user_period_start"
+            )
+        except OperationFailure as e:
+            logger.warning(f"Could not create unique user stats index, run scripts/compact_user_stats.py: {e}")
+        await self.stats_collection.create_index([("time_period.period_type", 1)])
+        await self.stats_collection.create_index([("user_id", 1), ("created_at", -1)])
+        await self.history_collection.create_index(
+            [("user_id", 1), ("period_type", 1), ("start_date", 1)],
+            unique=True
+        )
+
+    @staticmethod
+    def stats_filter(doc: Dict[str, Any]) -> Dict[str, Any]:
+        """Query matching the stored snapshot a document would replace"""
+        return {
+            "user_id": doc["user_id"],
+            "time_period.period_type": doc["time_period"]["period_type"],
+            "time_period.start_date": doc["time_period"]["start_date"]
+        }
+
+    @staticmethod
+    def stats_key(doc: Dict[str, Any]) -> Tuple[str, str, datetime]:
+        start_date = doc["time_period"]["start_date"]
+        # Mongo hands back naive UTC datetimes, so normalise before comparing
+        if start_date.tzinfo is not None:
+            start_date = start_date.astimezone(timezone.utc).replace(tzinfo=None)
+        return doc["user_id"], doc["time_period"]["period_type"], start_date
+
+    @classmethod
+    def history_update(cls, docs: List[Dict[str, Any]]) -> UpdateOne:
+        """Append superseded snapshots of one key to its capped history document"""
+        user_id, period_type, start_date = cls.stats_key(docs[0])
+        snapshots = [
+            {k: v for k, v in doc.items() if k not in ("_id", "user_id")}
+            for doc in sorted(docs, key=lambda d: d.get("created_at") or datetime.min)
+        ]
+        return UpdateOne(
+            {"user_id": user_id, "period_type": period_type, "start_date": start_date},
+            {"$push": {"snapshots": {"$each": snapshots, "$slice": -STATS_HISTORY_MAX_SNAPSHOTS}}},
+            upsert=True
+        )
+
+    async def _archive_snapshots(self, docs: List[Dict[str, Any]]):
+        by_key = {}
+        for doc in docs:
+            by_key.setdefault(self.stats_key(doc), []).append(doc)
+        if by_key:
+            await self.history_collection.bulk_write(
+                [self.history_update(key_docs) for key_docs in by_key.values()],
+                ordered=False
+            )
+
+    @staticmethod
+    def _to_millis(value):
+        # Mongo stores datetimes with millisecond precision
+        return value.replace(microsecond=value.microsecond // 1000 * 1000) if isinstance(value, datetime) else value
+
+    @classmethod
+    def _same_write(cls, previous: Dict[str, Any], doc: Dict[str, Any]) -> bool:
+        """Whether previous is doc itself, stored by an earlier attempt at the same batch"""
+        return cls._to_millis(previous.get("created_at")) == cls._to_millis(doc.get("created_at"))
 
-    async def save_user_stats(self, stats: UserStats) -> str:
+    async def _replace_unless_newer(self, doc: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """Store doc unless a newer snapshot of its key is stored; returns (replaced snapshot, whether doc is stale)
+
+        The replace is atomic per key, so it returns exactly the snapshot it overwrote
+        even with a concurrent durable write to the same key.
+        """
+        not_newer = {"$or": [{"created_at": {"$lte": self._to_millis(doc["created_at"])}}, {"created_at": {"$exists": False}}]}
+        previous = await self.stats_collection.find_one_and_replace({**self.stats_filter(doc), **not_newer}, doc)
+        if previous is not None:
+            return previous, False
+        # Nothing replaced: either the key is new or its stored snapshot is newer
+        result = await self.stats_collection.update_one(self.stats_filter(doc), {"$setOnInsert": doc}, upsert=True)
+        return None, result.upserted_id is None
+
+    async def _write_batch(self, documents: List[Dict[str, Any]]):
+        """Upsert a batch of buffered stats, archiving the snapshots they replace"""
+        latest = {}
+        superseded_in_batch = {}
+        for doc in documents:
+            key = self.stats_key(doc)
+            if key in latest:
+                superseded_in_batch.setdefault(key, []).append(latest[key])
+            latest[key] = doc
+
+        results = await asyncio.gather(
+            *(self._replace_unless_newer(doc) for doc in latest.values()),
+            return_exceptions=True
+        )
+
+        superseded = []
+        failures = []
+        for (key, doc), result in zip(latest.items(), results):
+            if isinstance(result, Exception):
+                failures.append(result)
+                continue
+            previous, stale = result
+            if previous is not None and self._same_write(previous, doc):
+                # Retry of a batch that partly failed; this key was already written and archived
+                continue
+            superseded += superseded_in_batch.get(key, [])
+            if stale:
+                # A newer snapshot (e.g. a durable save) is already stored
+                superseded.append(doc)
+            elif previous is not None:
+                superseded.append(previous)
+
+        # History is best effort; the current snapshots are already stored
+        try:
+            await self._archive_snapshots(superseded)
+        except Exception as e:
+            logger.error(f"Error archiving superseded user stats: {e}")
+
+        # The buffer requeues the whole batch; keys written above are recognised on retry
+        if failures:
+            raise failures[0]
+
+    async def save_user_stats(self, stats: UserStats, durable: Optional[bool] = None) -> str:
+        """
+        Save user stats, replacing any snapshot for the same user, period type and
+        start date. Unless durable (or STATS_WRITE_MODE=sync), the write is
+        acknowledged once it is in the write-behind buffer. Returns the stats key.
+        """
+        if durable is None:
+            durable = STATS_WRITE_MODE == "sync"
         try:
             logger.info(f"Saving stats for user: {stats.user_id}")
             stats_dict = stats.dict()
@@ -33,60 +176,124 @@ class UserStatsService:
                 raise ValueError(f"Invalid date format: {e}")
             
             logger.info(f"Processed stats: {stats_dict}")
-            result = await self.stats_collection.insert_one(stats_dict)
-            return str(result.inserted_id)
+            if durable:
+                # Buffered snapshots are older; store them first so they never replace this one
+                await self.write_buffer.flush()
+                previous = await self.stats_collection.find_one_and_replace(
+                    self.stats_filter(stats_dict),
+                    stats_dict,
+                    upsert=True
+                )
+                if previous:
+                    await self._archive_snapshots([previous])
+            else:
+                await self.write_buffer.add(self._write_batch, stats_dict)
+
+            # The user's cached response is stale, and the new sample moves the distribution
+            self.cache.invalidate(stats.user_id)
+            self.cache.record_write(
+                stats.time_period.period_type,
+                stats.total_trips / (stats.time_period.total_days / 7)
+            )
+            user_id, period_type, start_date = self.stats_key(stats_dict)
+            return f"{user_id}:{period_type}:{start_date.isoformat()}"
         except Exception as e:
             logger.error(f"Error saving user stats: {e}")
             raise
 
     async def get_user_stats(self, user_id: str) -> Optional[UserStats]:
-        stats = await self.stats_collection.find_one({"user_id": user_id})
+        # Read our own writes that haven't been flushed yet
+        pending = self.write_buffer.pending_documents({"user_id": user_id})
+        if pending:
+            stats = dict(pending[-1], time_period=dict(pending[-1]['time_period']))
+        else:
+            stats = await self.stats_collection.find_one({"user_id": user_id}, sort=[("created_at", -1)])
         if stats:
+            # Dates are stored as datetimes but TimePeriod expects ISO strings
+            for key in ('start_date', 'end_date'):
+                if isinstance(stats['time_period'][key], datetime):
+                    stats['time_period'][key] = stats['time_period'][key].isoformat()
             return UserStats(**stats)
         return None
 
     async def calculate_comparison_stats(self, stats: UserStats) -> ComparisonStats:
         try:
             logger.info("Calculating comparison stats")
-            # Get all stats for the same period type
-            all_stats = await self.stats_collection.find({
-                "time_period.period_type": stats.time_period.period_type
-            }).to_list(length=None)
+            period_type = stats.time_period.period_type
+            current_trips_per_week = stats.total_trips / (stats.time_period.total_days / 7)
+
+            # Buffered writes replace whatever is stored under the same key
+            pending = {
+                self.stats_key(s): s
+                for s in self.write_buffer.pending_documents({"time_period.period_type": period_type})
+            }
+            match = {"time_period.period_type": period_type}
+            if pending:
+                match["$nor"] = [self.stats_filter(s) for s in pending.values()]
+
+            # Summarise the distribution server-side instead of fetching every document
+            summary = await self.stats_collection.aggregate([
+                {"$match": match},
+                {"$group": {
+                    "_id": None,
+                    "count": {"$sum": 1},
+                    "total": {"$sum": TRIPS_PER_WEEK_EXPR},
+                    "at_or_below": {"$sum": {"$cond": [{"$lte": [TRIPS_PER_WEEK_EXPR, current_trips_per_week]}, 1, 0]}}
+                }}
+            ]).to_list(length=1)
+            count, total, at_or_below = (
+                (summary[0]["count"], summary[0]["total"], summary[0]["at_or_below"]) if summary else (0, 0.0, 0)
+            )
+
+            pending_trips_per_week = [
+                s['total_trips'] / (s['time_period']['total_days'] / 7)
+                for s in pending.values()
+            ]
+            count += len(pending_trips_per_week)
+            total += sum(pending_trips_per_week)
+            at_or_below += sum(1 for t in pending_trips_per_week if t <= current_trips_per_week)
             
-            if not all_stats:
+            if not count:
                 logger.info("No existing stats found for comparison")
                 return ComparisonStats(
                     percentile=50,
-                    average_trips_per_week=stats.total_trips / (stats.time_period.total_days / 7),
+                    average_trips_per_week=current_trips_per_week,
                     comparison_message="Not enough data for comparison yet"
                 )
 
-            # Calculate trips per week for comparison
-            current_trips_per_week = stats.total_trips / (stats.time_period.total_days / 7)
-            all_trips_per_week = [
-                s['total_trips'] / (s['time_period']['total_days'] / 7) 
-                for s in all_stats
-            ]
+            self.cache.observe_distribution(period_type, count, total)
 
-            percentile = float(np.percentile(all_trips_per_week, current_trips_per_week))
+            percentile = 100.0 * at_or_below / count
             logger.info(f"Calculated percentile: {percentile}")
             
-            # Generate comparison message
-            comparison_message = self._generate_comparison_message(
-                stats.user_estimate.estimated_trips_per_week if stats.user_estimate else None,
-                current_trips_per_week
-            )
-
-            return ComparisonStats(
-                percentile=percentile,
-                average_trips_per_week=current_trips_per_week,
-                comparison_message=comparison_message
+            return self.build_comparison_stats(
+                current_trips_per_week,
+                percentile,
+                stats.user_estimate.estimated_trips_per_week if stats.user_estimate else None
             )
         except Exception as e:
             logger.error(f"Error calculating comparison stats: {e}")
             raise
 
-    def _generate_comparison_message(self, estimated: Optional[int], actual: float) -> str:
+    @staticmethod
+    def calculate_percentile(trips_per_week: float, all_trips_per_week: List[float]) -> float:
+        """Percentage of users taking at most as many trips per week"""
+        if not all_trips_per_week:
+            return 50.0
+        at_or_below = sum(1 for other in all_trips_per_week if other <= trips_per_week)
+        return 100.0 * at_or_below / len(all_trips_per_week)
+
+    @classmethod
+    def build_comparison_stats(cls, trips_per_week: float, percentile: float,
+                               estimated_trips_per_week: Optional[int] = None) -> ComparisonStats:
+        return ComparisonStats(
+            percentile=percentile,
+            average_trips_per_week=trips_per_week,
+            comparison_message=cls._generate_comparison_message(estimated_trips_per_week, trips_per_week)
+        )
+
+    @staticmethod
+    def _generate_comparison_message(estimated: Optional[int], actual: float) -> str:
         if not estimated:
             return f"You take {actual:.1f} trips per week on average"
         
@@ -98,7 +305,8 @@ class UserStatsService:
         else:
             return f"You take {abs(difference_percent):.0f}% fewer trips than you estimated!"
 
-    def determine_personality(self, percentile: float, estimate_accuracy: float = None) -> TransitPersonality:
+    @staticmethod
+    def determine_personality(percentile: float, estimate_accuracy: float = None) -> TransitPersonality:
         personality_type = ""
         description = ""
         estimate_message = None
@@ -134,36 +342,53 @@ class UserStatsService:
             estimate_accuracy=estimate_message
         )
 
-    async def process_user_stats(self, stats: UserStats) -> UserStatsResponse:
+    async def process_user_stats(self, stats: UserStats, durable: Optional[bool] = None) -> UserStatsResponse:
         try:
             logger.info("Processing user stats")
             # Save stats
-            await self.save_user_stats(stats)
-
-            # Calculate comparison stats
-            comparison = await self.calculate_comparison_stats(stats)
-
-            # Calculate estimate accuracy if available
-            estimate_accuracy = None
-            if stats.user_estimate:
-                estimate_accuracy = 100 - min(100, abs(
-                    ((stats.user_estimate.actual_trips_per_week - stats.user_estimate.estimated_trips_per_week) 
-                     / stats.user_estimate.estimated_trips_per_week) * 100
-                ))
-
-            # Determine personality
-            personality = self.determine_personality(
-                comparison.percentile,
-                estimate_accuracy
-            )
+            await self.save_user_stats(stats, durable)
 
-            response = UserStatsResponse(
-                stats=stats,
-                personality=personality,
-                comparison=comparison
-            )
+            response = await self.build_user_stats_response(stats)
             logger.info("Successfully processed user stats")
             return response
         except Exception as e:
             logger.error(f"Error processing user stats: {e}")
-            raise 
\ No newline at end of file
+            raise
+
+    async def get_cached_user_stats_response(self, user_id: str) -> Optional[UserStatsResponse]:
+        """Read-only lookup of a user's stats response, served from cache when fresh"""
+        response = self.cache.get(user_id)
+        if response is not None:
+            return response
+
+        stats = await self.get_user_stats(user_id)
+        if not stats:
+            return None
+
+        response = await self.build_user_stats_response(stats)
+        self.cache.set(user_id, response)
+        return response
+
+    async def build_user_stats_response(self, stats: UserStats) -> UserStatsResponse:
+        # Calculate comparison stats
+        comparison = await self.calculate_comparison_stats(stats)
+
+        # Calculate estimate accuracy if available
+        estimate_accuracy = None
+        if stats.user_estimate:
+            estimate_accuracy = 100 - min(100, abs(
+                ((stats.user_estimate.actual_trips_per_week - stats.user_estimate.estimated_trips_per_week) 
+                 / stats.user_estimate.estimated_trips_per_week) * 100
+            ))
+
+        # Determine personality
+        personality = self.determine_personality(
+            comparison.percentile,
+            estimate_accuracy
+        )
+
+        return UserStatsResponse(
+            stats=stats,
+            personality=personality,
+            comparison=comparison
+        )
@@ -0,0 +1,68 @@
+"""
+Payload benchmark for wrapped responses.
+
+Runs the analysis on a Compass Card CSV once, then reports the encoded size and
+encode time of the result for every supported encoding / compression pair.
+
+Usage:
+    python benchmarks/payload_benchmark.py compass_data.csv
+    python benchmarks/payload_benchmark.py merged.csv --partition-by CardId --repeat 50
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.responses import encode_body, compress_body, msgpack, brotli  # noqa: E402
+from app.services.analytics_service import AnalyticsService  # noqa: E402
+
+
+def time_call(func, repeat: int):
+    """Return (result, mean milliseconds) of calling func repeat times"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare wrapped response encodings")
+    parser.add_argument("csv_path", help="Compass Card CSV export to analyze")
+    parser.add_argument("--partition-by", default=None, help="Card/user column for merged exports")
+    parser.add_argument("--repeat", type=int, default=20, help="Encode iterations per measurement")
+    args = parser.parse_args()
+
+    service = AnalyticsService()
+    with open(args.csv_path, "rb") as f:
+        df = service.process_csv(f.read())
+    if args.partition_by:
+        wrapped = service.generate_partitioned_wrapped(df, args.partition_by)
+    else:
+        wrapped = service.generate_compass_wrapped(df)
+
+    media_types = ["application/json"]
+    if msgpack is not None:
+        media_types.append("application/msgpack")
+    else:
+        print("msgpack not installed, skipping MessagePack")
+    encodings = ["identity", "gzip"]
+    if brotli is not None:
+        encodings.append("br")
+    else:
+        print("brotli not installed, skipping br")
+
+    print(f"{'format':<22}{'encoding':<10}{'bytes':>10}{'encode ms':>12}{'compress ms':>13}")
+    for media_type in media_types:
+        body, encode_ms = time_call(lambda: encode_body(wrapped, media_type), args.repeat)
+        for encoding in encodings:
+            if encoding == "identity":
+                payload, compress_ms = body, 0.0
+            else:
+                payload, compress_ms = time_call(lambda: compress_body(body, encoding), args.repeat)
+            print(f"{media_type:<22}{encoding:<10}{len(payload):>10}{encode_ms:>12.2f}{compress_ms:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Startup benchmark for the Compass Wrapped API.
+
+Measures how long it takes to import the app, checks that heavy analytics
+dependencies stay out of the startup path, and reports time to first
+response for a freshly started uvicorn process.
+
+Usage:
+    python benchmarks/startup_benchmark.py
+    python benchmarks/startup_benchmark.py --budget-ms 1200 --path /docs
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must only be loaded on the analytics path
+LAZY_MODULES = ("pandas", "numpy")
+
+
+def measure_import_time():
+    """Import app.main in a clean interpreter and return (total_ms, top_modules, loaded_lazy)"""
+    code = (
+        "import sys, app.main; "
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+
+    timings = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings.append((int(self_us), int(cumulative_us), name.strip()))
+
+    total_us = sum(cumulative for _, cumulative, name in timings if name in ("app", "app.main"))
+    # Rank by self time so the report points at the module actually doing the work
+    top_modules = sorted(((self_us, name) for self_us, _, name in timings), reverse=True)[:10]
+    loaded_lazy = [m for m in proc.stdout.strip().split(",") if m]
+    return total_us / 1000, top_modules, loaded_lazy
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_first_response(path: str, timeout: float):
+    """Start uvicorn and return seconds until the first response on path"""
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}{path}"
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                with urllib.request.urlopen(url, timeout=timeout) as response:
+                    response.read()
+                return time.perf_counter() - start
+            except urllib.error.HTTPError:
+                # Any HTTP response counts as the server being up
+                return time.perf_counter() - start
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        return None
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API cold start cost")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", 1500)),
+                        help="Maximum allowed import time for app.main in milliseconds")
+    parser.add_argument("--path", default="/docs", help="Path to request for time to first response")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for the server")
+    parser.add_argument("--skip-server", action="store_true", help="Only measure import time")
+    args = parser.parse_args()
+
+    total_ms, top_modules, loaded_lazy = measure_import_time()
+    print(f"Import time for app.main: {total_ms:.1f} ms (budget {args.budget_ms:.0f} ms)")
+    print("Slowest modules (self time):")
+    for us, name in top_modules:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if loaded_lazy:
+        print(f"FAIL: lazily loaded modules imported at startup: {', '.join(loaded_lazy)}")
+        failed = True
+    if total_ms > args.budget_ms:
+        print("FAIL: import time exceeds budget")
+        failed = True
+
+    if not args.skip_server:
+        elapsed = measure_first_response(args.path, args.timeout)
+        if elapsed is None:
+            print(f"FAIL: no response from {args.path} within {args.timeout:.0f}s")
+            failed = True
+        else:
+            print(f"Time to first response ({args.path}): {elapsed * 1000:.1f} ms")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+One-off compaction of the user_stats collection.
+
+Older deployments inserted a new user_stats document on every request. This
+keeps the newest snapshot for each (user_id, period_type, start_date), moves the
+superseded ones into user_stats_history, and then creates the unique index that
+lets new writes upsert.
+
+Usage:
+    python scripts/compact_user_stats.py --dry-run
+    python scripts/compact_user_stats.py
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv  # noqa: E402
+from pymongo import MongoClient  # noqa: E402
+from pymongo.errors import OperationFailure  # noqa: E402
+
+from app.services.user_stats_service import UserStatsService  # noqa: E402
+
+DUPLICATES_PIPELINE = [
+    {"$sort": {"created_at": 1}},
+    {"$group": {
+        "_id": {
+            "user_id": "$user_id",
+            "period_type": "$time_period.period_type",
+            "start_date": "$time_period.start_date"
+        },
+        "ids": {"$push": "$_id"},
+        "count": {"$sum": 1}
+    }},
+    {"$match": {"count": {"$gt": 1}}}
+]
+
+
+def compact(db, dry_run: bool = False, batch_size: int = 500):
+    stats_collection = db.user_stats
+    history_collection = db.user_stats_history
+
+    groups = 0
+    removed = 0
+    history_updates = []
+    superseded_ids = []
+
+    def flush():
+        if not dry_run and history_updates:
+            history_collection.bulk_write(history_updates, ordered=False)
+            stats_collection.delete_many({"_id": {"$in": superseded_ids}})
+        history_updates.clear()
+        superseded_ids.clear()
+
+    for group in stats_collection.aggregate(DUPLICATES_PIPELINE, allowDiskUse=True):
+        # ids are in created_at order; keep the newest
+        ids = group["ids"][:-1]
+        docs = list(stats_collection.find({"_id": {"$in": ids}}))
+        history_updates.append(UserStatsService.history_update(docs))
+        superseded_ids.extend(ids)
+        groups += 1
+        removed += len(ids)
+        if len(superseded_ids) >= batch_size:
+            flush()
+    flush()
+
+    print(f"{'Would compact' if dry_run else 'Compacted'} {groups} duplicated keys, "
+          f"{'moving' if dry_run else 'moved'} {removed} superseded snapshots to user_stats_history")
+
+    if not dry_run:
+        try:
+            stats_collection.create_index(
+                [("user_id", 1), ("time_period.period_type", 1), ("time_period.start_date", 1)],
+                unique=True,
+                name="user_period_start"
+            )
+            print("Created unique index user_period_start")
+        except OperationFailure as e:
+            print(f"Could not create unique index (new duplicates written meanwhile?): {e}")
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Deduplicate user_stats into user_stats_history")
+    parser.add_argument("--mongodb-url", default=os.getenv("MONGODB_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be compacted")
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongodb_url)
+    try:
+        compact(client.compass_wrapped, dry_run=args.dry_run)
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
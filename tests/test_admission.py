@@ -0,0 +1,49 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app import admission
+from app.admission import AdmissionController, AdmissionRejected, InMemoryTokenBuckets, client_id
+
+
+def make_request(forwarded_for: str = None, host: str = "10.0.0.1"):
+    headers = {"x-forwarded-for": forwarded_for} if forwarded_for is not None else {}
+    return SimpleNamespace(headers=headers, client=SimpleNamespace(host=host), app=None)
+
+
+def test_client_id_ignores_entries_forged_by_the_client(monkeypatch):
+    monkeypatch.setattr(admission, "TRUSTED_PROXY_HOPS", 1)
+    assert client_id(make_request("1.2.3.4, 203.0.113.7")) == "203.0.113.7"
+    assert client_id(make_request("5.6.7.8, 203.0.113.7")) == "203.0.113.7"
+    assert client_id(make_request()) == "10.0.0.1"
+
+    monkeypatch.setattr(admission, "TRUSTED_PROXY_HOPS", 0)
+    assert client_id(make_request("203.0.113.7")) == "10.0.0.1"
+
+
+def test_in_memory_buckets_are_capped(monkeypatch):
+    monkeypatch.setattr(admission, "MAX_TRACKED_CLIENTS", 3)
+    buckets = InMemoryTokenBuckets(capacity=10, refill_per_second=0)
+
+    async def run():
+        for i in range(5):
+            await buckets.take(f"client-{i}", 5)
+
+    asyncio.run(run())
+    assert list(buckets._buckets) == ["client-2", "client-3", "client-4"]
+
+
+def test_busy_rejection_refunds_tokens():
+    controller = AdmissionController(max_inflight_cost=5, max_queue=0, queue_timeout=0.01)
+    controller.buckets = InMemoryTokenBuckets(capacity=50, refill_per_second=0)
+    request = make_request()
+
+    async def run():
+        await controller.acquire(request, 5)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire(request, 3)
+        assert rejected.value.status_code == 503
+
+    asyncio.run(run())
+    assert controller.buckets._refilled("10.0.0.1") == 45
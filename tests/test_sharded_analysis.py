@@ -0,0 +1,54 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.services.analytics_service import AnalyticsService
+from app.services.process_pool import shutdown_process_pool
+
+HEADER = ("DateTime,Transaction,Product,LineItem,Amount,BalanceDetails,JourneyId,LocationDisplay,"
+          "TransactonTime,OrderDate,Payment,OrderNumber,AuthCode,Total")
+STATIONS = ["Commercial-Broadway Stn", "Waterfront Stn", "Metrotown Stn", "Main St-Science World Stn"]
+
+
+def make_csv(journeys: int, seed: int) -> bytes:
+    """Synthetic export with station and bus journeys, transfers and missing taps"""
+    rng = random.Random(seed)
+    rows = [HEADER]
+    started_at = datetime(2024, 1, 1, 6, 0)
+    for _ in range(journeys):
+        started_at += timedelta(minutes=rng.randint(60, 2000))
+        journey_id = started_at.strftime("%Y-%m-%dT%H:%M:00.0000000Z")
+        transactions = []
+        if rng.random() < 0.5:
+            transactions.append(f"Tap in at {rng.choice(STATIONS)}")
+        elif rng.random() > 0.1:
+            transactions.append(f"Tap in at Bus Stop {rng.randint(50000, 50005)}")
+        transactions += [f"Transfer at Bus Stop {rng.randint(50000, 50005)}" for _ in range(rng.choice([0, 0, 1, 3]))]
+        if rng.random() > 0.3:
+            transactions.append(f"Tap out at {rng.choice(STATIONS)}")
+
+        tapped_at = started_at
+        for transaction in transactions:
+            tapped_at += timedelta(minutes=rng.randint(1, 40))
+            rows.append(
+                f'{tapped_at.strftime("%b-%d-%Y %I:%M %p")},{transaction},3 Zone UPass (N),,$0.00,$0.00,'
+                f'{journey_id},"{transaction}\n3 Zone UPass (N)",{tapped_at.strftime("%I:%M %p")},,,,,'
+            )
+    return ("\n".join(rows) + "\n").encode()
+
+
+@pytest.fixture(scope="module", autouse=True)
+def process_pool():
+    yield
+    shutdown_process_pool()
+
+
+@pytest.mark.parametrize("journeys, seed", [(1, 0), (3, 1), (40, 2), (400, 3), (1500, 4)])
+def test_sharded_analysis_matches_single_process(journeys, seed):
+    service = AnalyticsService()
+    df = service.process_csv(make_csv(journeys, seed))
+    expected = service.generate_compass_wrapped(df, 10, shards=1)
+
+    for shards in (2, 3, 7):
+        assert service.generate_compass_wrapped(df, 10, shards=shards) == expected, f"{shards} shards"
@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+from app.models import UserStats
+from app.services.stats_write_buffer import StatsWriteBuffer
+from app.services.user_stats_service import UserStatsService
+
+
+def make_stats(user_id: str, total_trips: int) -> UserStats:
+    return UserStats(
+        user_id=user_id,
+        total_trips=total_trips,
+        total_hours=1,
+        most_used_transit="Bus",
+        top_stops=[],
+        top_routes=[],
+        time_period={
+            "start_date": "2023-01-01T00:00:00Z",
+            "end_date": "2023-12-31T00:00:00Z",
+            "period_type": "yearly",
+            "total_days": 365
+        }
+    )
+
+
+def make_service() -> UserStatsService:
+    service = UserStatsService(mongomock_motor.AsyncMongoMockClient())
+    service.write_buffer = StatsWriteBuffer(max_batch=1000, flush_interval=3600)
+    return service
+
+
+async def history(service: UserStatsService, user_id: str) -> list:
+    doc = await service.history_collection.find_one({"user_id": user_id})
+    return [snapshot["total_trips"] for snapshot in doc["snapshots"]] if doc else []
+
+
+def test_durable_save_is_not_overwritten_by_older_buffered_save():
+    async def run():
+        service = make_service()
+        await service.ensure_indexes()
+        await service.save_user_stats(make_stats("u0", 50))
+        await asyncio.sleep(0.002)
+        await service.save_user_stats(make_stats("u0", 999), durable=True)
+
+        assert (await service.get_user_stats("u0")).total_trips == 999
+        await service.write_buffer.flush()
+        stored = await service.stats_collection.find({"user_id": "u0"}).to_list(length=None)
+        assert [doc["total_trips"] for doc in stored] == [999]
+        assert await history(service, "u0") == [50]
+
+    asyncio.run(run())
+
+
+def test_requeued_buffered_save_does_not_replace_newer_snapshot():
+    async def run():
+        service = make_service()
+        await service.ensure_indexes()
+        await service.save_user_stats(make_stats("u0", 50))
+        # The buffered snapshot is older, as if its flush had failed and been requeued
+        older = service.write_buffer.pending_documents({"user_id": "u0"})
+        service.write_buffer._pending = []
+        # Stored timestamps have millisecond precision
+        await asyncio.sleep(0.002)
+        await service.save_user_stats(make_stats("u0", 999), durable=True)
+
+        await service._write_batch(older)
+        stored = await service.stats_collection.find({"user_id": "u0"}).to_list(length=None)
+        assert [doc["total_trips"] for doc in stored] == [999]
+        assert await history(service, "u0") == [50]
+
+    asyncio.run(run())
+
+
+def test_retried_batch_archives_each_snapshot_once():
+    async def run():
+        service = make_service()
+        await service.ensure_indexes()
+        await service.save_user_stats(make_stats("u0", 1), durable=True)
+        await asyncio.sleep(0.002)
+        await service.save_user_stats(make_stats("u0", 2))
+        batch = list(service.write_buffer.pending_documents({}))
+
+        await service._write_batch(batch)
+        await service._write_batch(batch)
+        stored = await service.stats_collection.find({"user_id": "u0"}).to_list(length=None)
+        assert [doc["total_trips"] for doc in stored] == [2]
+        assert await history(service, "u0") == [1]
+
+    asyncio.run(run())